@@ -25,11 +25,29 @@ __author__ = 'Joaquin Moreno Garijo (bastionado@gmail.com)'
 
 # Disclaimer: it only was probed in 10.8 and 10.9.
 
+import argparse
+import array
+import calendar
+import collections
 import construct
+import heapq
+import marshal
+import mmap
+import multiprocessing
 import os
+import re
+import shutil
 import struct
 import sys
+import tempfile
 import time
+import zlib
+
+# NumPy is only needed to export the records as an array.
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 # Magic file number.
 ASL_MAGIC = 'ASL DB\x00\x00\x00\x00\x00\x00'
@@ -92,6 +110,127 @@ ASL_RECORD_DYN_VALUE = construct.Struct(
     construct.PascalString(
         'value', length_field = construct.UBInt32('length')))
 
+# Length field of a dynamic value, after its 2 bytes of padding.
+ASL_DYN_VALUE_LENGTH = struct.Struct('>I')
+
+# Precompiled decoders, construct is only kept as reference implementation.
+
+# Same layout as ASL_RECORD_STRUCT.
+ASL_RECORD_HEADER = struct.Struct('>2xIQQQIHHIIIIIQ')
+ASLRecordHeader = collections.namedtuple('ASLRecordHeader', [
+    'tam_entry', 'next_offset', 'ASLMessageID', 'timestamp', 'nanosec',
+    'level', 'flags', 'pid', 'uid', 'gid', 'read_uid', 'read_gid',
+    'ref_pid'])
+
+# Value slot (ASL_RECORD_ADDR_TXT) as an integer:
+#  0: no value.
+#  high nibble 0x8: the text is inside the slot (7 bytes).
+#  other: pointer to an ASL_RECORD_DYN_VALUE.
+ASL_RECORD_SLOT = struct.Struct('>Q')
+ASL_SLOT_TEXT_MASK = 0xF << 60
+ASL_SLOT_TEXT = 0x8 << 60
+
+# Only tam_entry, next_offset and timestamp of a Record_Struct, for skimRecords.
+ASL_RECORD_SKIM = struct.Struct('>2xIQ8xQ')
+
+# Available decoders for the records.
+ASL_DECODERS = ['struct', 'construct', 'verify']
+
+# Default number of heap strings kept by HeapStringCache.
+ASL_CACHE_SIZE = 4096
+
+# Default memory budget against corrupted or hostile files: bytes of a
+# dynamic value and bytes of all the values of a record (see
+# setMemoryBudget).
+ASL_MAX_VALUE_SIZE = 1024 * 1024
+ASL_MAX_RECORD_SIZE = 4 * 1024 * 1024
+
+# Sidecar time index: [Index_Header][Time_Entry]*[ID_Entry]*
+# The file size and last_offset of the ASL file are saved to know if the
+# index is still valid. Time entries are sorted by (timestamp, ASLMessageID)
+# and ID entries by (ASLMessageID, timestamp).
+ASL_INDEX_MAGIC = 'ASLIDX\x00\x01'
+ASL_INDEX_HEADER = struct.Struct('>8sQQQ')
+ASL_INDEX_ENTRY = struct.Struct('>QQQ')
+ASL_INDEX_EXTENSION = '.idx'
+
+# Sidecar text index: [Text_Header][Record_Entry]*[Trigram_Entry]*[Postings]
+# Record entries are the offsets of the records, in the order of the chain.
+# Trigram entries are sorted by trigram (of the lowercase text of the values,
+# but not of the key names) and point to a sorted list of record numbers.
+ASL_TEXT_MAGIC = 'ASLTRI\x00\x01'
+ASL_TEXT_HEADER = struct.Struct('>8sQQQQ')
+ASL_TEXT_RECORD = struct.Struct('>Q')
+ASL_TEXT_TRIGRAM = struct.Struct('>3sxQI')
+ASL_TEXT_POSTING = 'I'
+ASL_TEXT_EXTENSION = '.tri'
+
+# Archive of parsed records: [Magic]([Block_Length][zlib(Block)])*
+# Block = [Block_Header][New strings][Archive_Record]*[Codes][Values]
+# The strings (hosts, senders, facilities, key names and message templates)
+# are written once, in the block where they are used for the first time, and
+# referenced by their position. A template is a message without its
+# variable parts, they are saved in Values with the values of the extra keys.
+ASL_ARCHIVE_MAGIC = 'ASLARC\x00\x02'
+ASL_ARCHIVE_LENGTH = struct.Struct('>I')
+# Records, new strings, bytes of the new strings, codes and values.
+ASL_ARCHIVE_BLOCK = struct.Struct('>IIIII')
+# ASLRecordHeader, offset of the record and number of values.
+ASL_ARCHIVE_RECORD = struct.Struct('>IQQQIHHIIIIIQQI')
+ASL_ARCHIVE_CODE = 'I'
+ASL_ARCHIVE_BLOCK_RECORDS = 4096
+# Variable parts of a message: numbers, hexadecimal numbers and UUIDs.
+ASL_ARCHIVE_VARIABLE = re.compile(
+    r'[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-'
+    r'[0-9A-Fa-f]{12}|0x[0-9A-Fa-f]+|\d+')
+# Where a variable part was in a template.
+ASL_ARCHIVE_PARAMETER = '\x01'
+
+# Extension of the files of an ASL store directory.
+ASL_FILE_EXTENSION = '.asl'
+
+# Names of the store files: YYYY.MM.DD.*.asl with the records of a day, and
+# BB.YYYY.MM.DD.*.asl with records that are kept until that day.
+ASL_STORE_FILE_NAME = re.compile(r'^(BB\.)?(\d{4})\.(\d{2})\.(\d{2})\.')
+# The names use the local time of the computer, so the day can start up to
+# 14 hours before or after in UTC.
+ASL_STORE_TIME_SLACK = 14 * 3600
+# File of the store with the next ASLMessageID (8 bytes, big endian).
+ASL_STORE_DATA = 'StoreData'
+ASL_STORE_DATA_STRUCT = struct.Struct('>Q')
+
+# Columns of the array built by recordFieldsArray.
+ASL_RECORD_FIELDS = [
+    ('timestamp', 'u8'), ('nanosec', 'u4'), ('level', 'u2'), ('flags', 'u2'),
+    ('pid', 'u4'), ('uid', 'u4'), ('gid', 'u4'), ('read_uid', 'u4'),
+    ('read_gid', 'u4'), ('ref_pid', 'u8'), ('ASLMessageID', 'u8'),
+    ('offset', 'u8')]
+
+# Carving: a Record_Struct starts with the type of the entry (2 for the
+# records, 1 for the dynamic values), a tam_entry under 1MB, a next_offset
+# under 4GB, a timestamp between 1995 and 2038, the nanoseconds and a level
+# between 0 and 7. The pattern starts in the second byte of the type, a literal
+# that is not zero, so long runs of zeros are skipped as fast as random data.
+ASL_CARVE_PATTERN = re.compile(
+    '\x02\x00[\x00-\x0f]..'               # type, tam_entry
+    '\x00\x00\x00\x00....'                # next_offset
+    '........'                            # ASLMessageID
+    '\x00\x00\x00\x00[\x30-\x7f]...'      # timestamp
+    '[\x00-\x3b]...'                      # nanosec
+    '\x00[\x00-\x07]', re.DOTALL)         # level
+ASL_DYN_VALUE_TYPE = '\x00\x01'
+# Smallest tam_entry: Record_Struct and the four fixed value slots.
+ASL_RECORD_MIN_ENTRY = ASL_RECORD_HEADER.size + 4 * ASL_RECORD_SLOT.size + 2
+ASL_CARVE_CHUNK = 64 * 1024 * 1024
+
+# Names of the first four values of every record, the next ones are pairs of
+# key and value.
+ASL_FIXED_KEYS = ['Host', 'Sender', 'Facility', 'Message']
+
+# Values decoded by the statistics mode and size of each list of its report.
+ASL_STATS_KEYS = ['Sender', 'Message']
+ASL_STATS_TOP = 10
+
 # Print the header of the file
 def printHeader(header): 
   print "\nASL Header:"
@@ -107,7 +246,41 @@ def printHeader(header):
 #  values: values from the bottom part (Values)
 #  pos: where the Record_Structure starts in the file.
 def printRecord(record_header, values, pos):
-  # Static part of the entry
+  printRecordFields(record_header, pos)
+
+  # Dynamic part of the entry.
+  # Host, Sender, Facility, Message, Name_Field1, Field1, Name_Field2, Field2, ...
+  print '\t * Host: {0}'.format(values[0].partition('\x00')[0])
+  print '\t * Sender: {0}'.format(values[1].partition('\x00')[0])
+  print '\t * Facility: {0}'.format(values[2].partition('\x00')[0])
+  print '\t * Message: {0}'.format(values[3].partition('\x00')[0])
+  cont = 4
+  while cont < (len(values) - 1):
+      print '\t * {0}: {1}'.format(values[cont].partition('\x00')[0],
+          values[cont+1].partition('\x00')[0])
+      cont += 2
+  print '\t------------------------------------------------------'
+
+# Print a record with only some of its values (see projectValues).
+#
+# Args:
+#  record_header: values from the Record_Struct part.
+#  values: dictionary with the raw value of each key.
+#  pos: where the Record_Structure starts in the file.
+#  keys: the requested keys, in the order they are printed.
+def printProjection(record_header, values, pos, keys):
+  printRecordFields(record_header, pos)
+  for key in keys:
+    if key in values:
+      print '\t * {0}: {1}'.format(key, values[key].partition('\x00')[0])
+  print '\t------------------------------------------------------'
+
+# Print the static part of a record.
+#
+# Args:
+#  record_header: values from the Record_Struct part.
+#  pos: where the Record_Structure starts in the file.
+def printRecordFields(record_header, pos):
   human_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(record_header.timestamp))
   print '\t Record in: {}'.format(hex(pos))
   print '\t * Next record in: {}'.format(hex(record_header.next_offset))
@@ -123,99 +296,2176 @@ def printRecord(record_header, values, pos):
     fieldsID.append('Read_GID: {}'.format(record_header.read_gid))
   print '\t * {}'.format(', '.join(fieldsID))
 
-  # Dynamic part of the entry.
-  # Host, Sender, Facility, Message, Name_Field1, Field1, Name_Field2, Field2, ...
-  print '\t * Host: {0}'.format(values[0].partition('\x00')[0])
-  print '\t * Sender: {0}'.format(values[1].partition('\x00')[0])
-  print '\t * Facility: {0}'.format(values[2].partition('\x00')[0])
-  print '\t * Message: {0}'.format(values[3].partition('\x00')[0])
-  cont = 4
-  while cont < (len(values) - 1):
-      print '\t * {0}: {1}'.format(values[cont].partition('\x00')[0],
-          values[cont+1].partition('\x00')[0])
-      cont += 2
-  print '\t------------------------------------------------------'
+# Memory budget in use.
+max_value_size = ASL_MAX_VALUE_SIZE
+max_record_size = ASL_MAX_RECORD_SIZE
 
-# Main program
-def __init__():
-  if len(sys.argv) != 2:
-    print 'Use: python {0} ASLfile'.format(sys.argv[0])
+# Change the memory budget of the decoders.
+#
+# A record with a value or a tam_entry over the budget, or that points
+# outside of the file, is not decoded: the decoders raise ValueError before
+# anything is copied, and the walkers skip it and continue with the next one.
+#
+# Args:
+#  value_size: maximum bytes of a dynamic value.
+#  record_size: maximum bytes of the value slots and of all the values of a
+#               record.
+def setMemoryBudget(value_size=ASL_MAX_VALUE_SIZE,
+                    record_size=ASL_MAX_RECORD_SIZE):
+  global max_value_size, max_record_size
+  max_value_size = value_size
+  max_record_size = record_size
+
+# Length of a dynamic value, checked against the file and the budget.
+#
+# Raises:
+#  ValueError: if the value does not fit in the file or in the budget.
+def dynValueLength(data, addr):
+  if addr + 6 > len(data):
+    raise ValueError('Value in {} out of the file.'.format(hex(addr)))
+  length, = ASL_DYN_VALUE_LENGTH.unpack_from(data, addr + 2)
+  if length > max_value_size or addr + 6 + length > len(data):
+    raise ValueError('Value of {} bytes in {} out of the file or the '
+                     'budget.'.format(length, hex(addr)))
+  return length
+
+# Check the size of a record before its values are decoded.
+#
+# Raises:
+#  ValueError: if the record does not fit in the file or in the budget.
+def checkRecordSize(data, offset, record_header):
+  tam_entry = record_header.tam_entry
+  if (tam_entry < ASL_RECORD_HEADER.size + 2 or
+      tam_entry > max_record_size or offset + tam_entry + 6 > len(data)):
+    raise ValueError('Record of {} bytes out of the file or the '
+                     'budget.'.format(tam_entry))
+
+# Read a dynamic value (ASL_RECORD_DYN_VALUE) from the mapped file.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  addr: position in the file where the dynamic value starts.
+#
+# Returns:
+#  The raw value. Only the bytes of the value itself are copied.
+#
+# Raises:
+#  ValueError: if the value does not fit in the file or in the budget.
+def readDynValue(data, addr):
+  length = dynValueLength(data, addr)
+  return data[addr + 6:addr + 6 + length]
+
+# LRU cache of the dynamic values that are shared by several records.
+#
+# Host, sender, facility and key names are written once in the heap and the
+# next records point to them, the cache is keyed by that offset.
+class HeapStringCache(object):
+
+  def __init__(self, data, max_size=ASL_CACHE_SIZE):
+    self.data = data
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._values = collections.OrderedDict()
+
+  # Args:
+  #  addr: position in the file where the dynamic value starts.
+  # Returns:
+  #  The raw value, decoded only the first time it is requested.
+  def get(self, addr):
+    try:
+      value = self._values.pop(addr)
+      self.hits += 1
+    except KeyError:
+      value = readDynValue(self.data, addr)
+      self.misses += 1
+      if self.max_size <= 0:
+        return value
+      if len(self._values) >= self.max_size:
+        # Least recently used value.
+        self._values.popitem(last=False)
+    self._values[addr] = value
+    return value
+
+  # Forget the cached values, when the file is replaced by another one.
+  def clear(self):
+    self._values.clear()
+
+# Decode the Record_Struct part of a record.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  offset: where the Record_Struct starts.
+#
+# Returns:
+#  An ASLRecordHeader.
+def decodeRecordHeader(data, offset):
+  return ASLRecordHeader._make(ASL_RECORD_HEADER.unpack_from(data, offset))
+
+# Decode the Values part of a record.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  slot: where the first value slot starts.
+#  tam_entry: number of bytes used by the value slots.
+#  heap_start: where the heap of this record starts, the values before it
+#              belong to previous records and are read through the cache.
+#  cache: optional HeapStringCache.
+#
+# Returns:
+#  A list with the raw values.
+#
+# Raises:
+#  ValueError: if the values do not fit in the file or in the budget.
+def decodeValues(data, slot, tam_entry, heap_start=0, cache=None):
+  values = []
+  size = 0
+  while tam_entry > 0:
+    addr_txt, = ASL_RECORD_SLOT.unpack_from(data, slot)
+    # If not direction or data, jump to the next 8 bytes
+    if addr_txt:
+      if addr_txt & ASL_SLOT_TEXT_MASK == ASL_SLOT_TEXT:
+        values.append(data[slot + 1:slot + 8])
+      else:
+        # The pointer can be in the heap of this entry or of a previous one.
+        if cache is not None and addr_txt < heap_start:
+          value = cache.get(addr_txt)
+        else:
+          value = readDynValue(data, addr_txt)
+        size += len(value)
+        if size > max_record_size:
+          raise ValueError('Values of more than {} bytes.'.format(
+              max_record_size))
+        values.append(value)
+    slot += 8
+    tam_entry -= 8
+  return values
+
+# Decode only the values of some keys of a record.
+#
+# The slots are walked as in decodeValues, but a pointer is only followed for
+# the key names (they are needed to know which pair it is) and for the values
+# of the requested keys, the rest of the slots are left as they are.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  slot: where the first value slot starts.
+#  tam_entry: number of bytes used by the value slots.
+#  keys: set with the requested keys, ASL_FIXED_KEYS or extra key names.
+#  heap_start: where the heap of this record starts.
+#  cache: optional HeapStringCache.
+#
+# Returns:
+#  A dictionary with the raw value of each requested key that the record has.
+def projectValues(data, slot, tam_entry, keys, heap_start=0, cache=None):
+  values = {}
+  # Without extra keys, nothing after the Message is needed.
+  fixed_only = keys.issubset(ASL_FIXED_KEYS)
+  position = 0
+  key = None
+  size = 0
+  while tam_entry > 0:
+    addr_txt, = ASL_RECORD_SLOT.unpack_from(data, slot)
+    if addr_txt:
+      if position < len(ASL_FIXED_KEYS):
+        wanted = ASL_FIXED_KEYS[position] in keys
+      else:
+        # Key names are in the even positions, their values follow them.
+        wanted = position % 2 == 0 or key in keys
+      if wanted:
+        if addr_txt & ASL_SLOT_TEXT_MASK == ASL_SLOT_TEXT:
+          value = data[slot + 1:slot + 8]
+        elif cache is not None and addr_txt < heap_start:
+          value = cache.get(addr_txt)
+        else:
+          value = readDynValue(data, addr_txt)
+        size += len(value)
+        if size > max_record_size:
+          raise ValueError('Values of more than {} bytes.'.format(
+              max_record_size))
+        if position < len(ASL_FIXED_KEYS):
+          values[ASL_FIXED_KEYS[position]] = value
+        elif position % 2 == 0:
+          key = value.partition('\x00')[0]
+        else:
+          values[key] = value
+      position += 1
+      if fixed_only and position >= len(ASL_FIXED_KEYS):
+        break
+    slot += 8
+    tam_entry -= 8
+  return values
+
+# Reference decoder of the Record_Struct part using construct.
+def decodeRecordHeaderConstruct(data, offset):
+  return ASL_RECORD_STRUCT.parse(
+      data[offset:offset + ASL_RECORD_STRUCT.sizeof()])
+
+# Reference decoder of the Values part using construct.
+def decodeValuesConstruct(data, slot, tam_entry, heap_start=0, cache=None):
+  values = []
+  while tam_entry > 0:
+    addr_txt = ASL_RECORD_ADDR_TXT.parse(data[slot:slot + 8]).addr_txt
+    slot += 8
+    tam_entry -= 8
+    if addr_txt.encode('hex') != '0000000000000000':
+      if addr_txt.encode('hex')[0:1] != '8':
+        # The mapped file is also a stream, seek where the value is.
+        dynValueLength(data, int(addr_txt.encode('hex'), 16))
+        data.seek(int(addr_txt.encode('hex'), 16))
+        values.append(ASL_RECORD_DYN_VALUE.parse_stream(data).value)
+      else:
+        values.append(addr_txt[1:])
+  return values
+
+# Decode a record with both decoders and check that they agree.
+#
+# Returns:
+#  The record decoded by construct, or exits if the decoders disagree.
+def decodeRecordVerify(data, offset):
+  record_header = decodeRecordHeaderConstruct(data, offset)
+  fast_header = decodeRecordHeader(data, offset)
+  checkRecordSize(data, offset, fast_header)
+  tam_entry = record_header.tam_entry - ASL_RECORD_STRUCT.sizeof() - 2
+  slot = offset + ASL_RECORD_STRUCT.sizeof()
+  values = decodeValuesConstruct(data, slot, tam_entry)
+  fast_values = decodeValues(data, slot, tam_entry)
+  for field in ASLRecordHeader._fields:
+    if getattr(record_header, field) != getattr(fast_header, field):
+      print '[Error] Decoders disagree in the field {} of the record {}.'.format(
+          field, hex(offset))
+      exit(1)
+  if values != fast_values:
+    print '[Error] Decoders disagree in the values of the record {}.'.format(
+        hex(offset))
     exit(1)
-  log = sys.argv[1]
+  return record_header, values
+
+# Decode the Record_Struct and the Values of a record.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  offset: where the Record_Struct starts.
+#  decoder: one of ASL_DECODERS.
+#  heap_start: where the heap of this record starts.
+#  cache: optional HeapStringCache.
+#  match: optional predicate over the Record_Struct (see buildFilter), the
+#         values of the records that do not match are not decoded.
+#  keys: optional set of keys, only their values are decoded (see
+#        projectValues), it always uses the struct decoder.
+#
+# Returns:
+#  (record_header, values), values is None if the record does not match. With
+#  keys, values is a dictionary.
+#
+# Raises:
+#  ValueError: if the record does not fit in the file or in the budget.
+#  struct.error: if the Record_Struct does not fit in the file.
+def decodeRecord(data, offset, decoder='struct', heap_start=0, cache=None,
+                 match=None, keys=None):
+  if keys is not None:
+    record_header = decodeRecordHeader(data, offset)
+    if match and not match(record_header):
+      return record_header, None
+    checkRecordSize(data, offset, record_header)
+    return record_header, projectValues(
+        data, offset + ASL_RECORD_HEADER.size,
+        record_header.tam_entry - ASL_RECORD_HEADER.size - 2, keys,
+        heap_start, cache)
+  if decoder == 'verify':
+    if match and not match(decodeRecordHeader(data, offset)):
+      return decodeRecordHeader(data, offset), None
+    return decodeRecordVerify(data, offset)
+  if decoder == 'construct':
+    decode_header, decode_values = (
+        decodeRecordHeaderConstruct, decodeValuesConstruct)
+  else:
+    decode_header, decode_values = decodeRecordHeader, decodeValues
+  record_header = decode_header(data, offset)
+  if match and not match(record_header):
+    return record_header, None
+  checkRecordSize(data, offset, record_header)
+  # -2 -> + 6 - 8
+  # +6 because the header already counts the padding + tam entry.
+  # -8 because the last 8 byte register is a pointer to the previous entry.
+  values = decode_values(
+      data, offset + ASL_RECORD_HEADER.size,
+      record_header.tam_entry - ASL_RECORD_HEADER.size - 2, heap_start, cache)
+  return record_header, values
+
+# Walk the records of an ASL file following the next_offset chain.
+#
+# The file is not read sequentially: the record structure and its values are
+# taken directly from the mapped file, so the heap in front of each record is
+# never copied and there is no seek to resolve pointers to other records.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#  decoder: one of ASL_DECODERS.
+#  cache: optional HeapStringCache shared by all the records.
+#  start: offset of the first record to read, by default header.offset.
+#  match: optional predicate over the Record_Struct (see buildFilter).
+#  keys: optional set of keys to decode (see projectValues).
+#
+# Yields:
+#  (pos, record_header, values), the same arguments printRecord expects.
+#  values is None for the records that do not match, and a dictionary when
+#  keys are given.
+def walkRecords(data, header, decoder='struct', cache=None, start=None,
+                match=None, keys=None):
+  if start is None:
+    offset = header.offset
+    # The heap of the first entry starts after the file header.
+    heap_start = ASL_HEADER_STRUCT.sizeof()
+  else:
+    offset = start
+    heap_start, _ = recordHeapStart(data, header, offset)
+  last_offset = header.last_offset
+
+  # A file without records has both offsets to 0.
+  while offset and offset <= last_offset:
+    try:
+      record_header, values = decodeRecord(
+          data, offset, decoder, heap_start, cache, match, keys)
+    except (ValueError, struct.error) as exception:
+      skipRecord(offset, exception)
+      offset = resyncRecord(data, header, offset)
+      heap_start = offset
+      continue
+
+    yield offset, record_header, values
+    # The heap of the next entry starts after the pointer to this one.
+    heap_start = offset + record_header.tam_entry + 6
+
+    # Last entry
+    if record_header.next_offset < offset:
+      break
+    # Jump to the next entry
+    offset = record_header.next_offset
+
+# Report a record that can not be decoded.
+def skipRecord(offset, exception):
+  sys.stderr.write('[WARNING] Skipping the record in {}: {}\n'.format(
+      hex(offset), exception))
+
+# Find the record that follows one that can not be decoded.
+#
+# Its next_offset is used if it points forward to something that looks like
+# a record (see carveRecordHeader), if not the file is scanned forward with
+# ASL_CARVE_PATTERN.
+#
+# Returns:
+#  The offset of the next record, or 0 if there is none.
+def resyncRecord(data, header, offset):
+  try:
+    next_offset = decodeRecordHeader(data, offset).next_offset
+    if (offset < next_offset <= header.last_offset and
+        next_offset < len(data) and
+        carveRecordHeader(data, next_offset) is not None):
+      return next_offset
+  except struct.error:
+    pass
+  end = min(header.last_offset + ASL_RECORD_HEADER.size, len(data))
+  for found in ASL_CARVE_PATTERN.finditer(data, offset + 2, end):
+    pos = found.start() - 1
+    if pos > header.last_offset:
+      break
+    try:
+      if carveRecordHeader(data, pos) is not None:
+        return pos
+    except struct.error:
+      break
+  return 0
+
+# Where the heap of a record starts, that is, where the previous one ends.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#  offset: where the Record_Struct starts.
+#
+# Returns:
+#  (heap_start, previous): previous is the offset of the previous record or
+#  None if this is the first one.
+def recordHeapStart(data, header, offset):
+  tam_entry, = ASL_DYN_VALUE_LENGTH.unpack_from(data, offset + 2)
+  # Pointer to the previous entry: the last 8 bytes of this one.
+  previous, = ASL_RECORD_SLOT.unpack_from(data, offset + tam_entry - 2)
+  if not header.offset <= previous < offset:
+    return ASL_HEADER_STRUCT.sizeof(), None
+  previous_tam, = ASL_DYN_VALUE_LENGTH.unpack_from(data, previous + 2)
+  return previous + previous_tam + 6, previous
+
+# Walk the records of an ASL file from the newest to the oldest one.
+#
+# It starts in header.last_offset and follows the pointer to the previous
+# entry that each record has in its last 8 bytes, so only the records that
+# are consumed are read.
+#
+# Args: the same as walkRecords.
+#
+# Yields:
+#  (pos, record_header, values), the newest record first.
+def walkRecordsReverse(data, header, decoder='struct', cache=None,
+                       match=None, keys=None):
+  offset = header.last_offset
+  while offset >= header.offset and offset:
+    try:
+      heap_start, previous = recordHeapStart(data, header, offset)
+      record_header, values = decodeRecord(
+          data, offset, decoder, heap_start, cache, match, keys)
+    except (ValueError, struct.error) as exception:
+      # Without a valid record there is no pointer to the previous one.
+      skipRecord(offset, exception)
+      break
+    yield offset, record_header, values
+    # First entry, or a pointer that does not go backwards.
+    if previous is None:
+      break
+    offset = previous
+
+# Decode the records that start in the given offsets.
+#
+# Args:
+#  offsets: iterable with the position of each Record_Struct.
+#  the rest as walkRecords.
+#
+# Yields:
+#  (pos, record_header, values) in the order of offsets.
+def readRecordsAt(data, header, offsets, decoder='struct', cache=None,
+                  match=None, keys=None):
+  for offset in offsets:
+    try:
+      heap_start, _ = recordHeapStart(data, header, offset)
+      record_header, values = decodeRecord(
+          data, offset, decoder, heap_start, cache, match, keys)
+    except (ValueError, struct.error) as exception:
+      skipRecord(offset, exception)
+      continue
+    yield offset, record_header, values
+
+# Walk only the Record_Struct part of the records, no value is read.
+#
+# A record that does not fit in the file or in the budget is skipped as in
+# walkRecords.
+#
+# Yields:
+#  (pos, record_header) following the next_offset chain.
+def walkRecordHeaders(data, header):
+  offset = header.offset
+  # A file without records has both offsets to 0.
+  while offset and offset <= header.last_offset:
+    try:
+      record_header = decodeRecordHeader(data, offset)
+      checkRecordSize(data, offset, record_header)
+    except (ValueError, struct.error) as exception:
+      skipRecord(offset, exception)
+      offset = resyncRecord(data, header, offset)
+      continue
+    yield offset, record_header
+    if record_header.next_offset < offset:
+      break
+    offset = record_header.next_offset
+
+# Fixed fields of the records in a NumPy structured array, one row per record.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#  match: optional predicate over the Record_Struct (see buildFilter).
+#  size: number of rows preallocated, the array grows if there are more
+#        records. By default it is the number of records that fit in the file.
+#
+# Returns:
+#  An array with the columns of ASL_RECORD_FIELDS, in the order of the
+#  record chain.
+#
+# Raises:
+#  ImportError: if NumPy is not installed.
+def recordFieldsArray(data, header, match=None, size=None):
+  if numpy is None:
+    raise ImportError('NumPy is needed to export the records as an array.')
+  if size is None:
+    # Upper bound: every record has its header, the back pointer and the
+    # four fixed value slots.
+    size = max(1, len(data) // (ASL_RECORD_HEADER.size + 6 + 32))
+  fields = numpy.zeros(size, dtype=ASL_RECORD_FIELDS)
+  count = 0
+  for offset, record_header in walkRecordHeaders(data, header):
+    if match is not None and not match(record_header):
+      continue
+    if count == len(fields):
+      fields.resize(max(1, 2 * count), refcheck=False)
+    fields[count] = (
+        record_header.timestamp, record_header.nanosec, record_header.level,
+        record_header.flags, record_header.pid, record_header.uid,
+        record_header.gid, record_header.read_uid, record_header.read_gid,
+        record_header.ref_pid, record_header.ASLMessageID, offset)
+    count += 1
+  fields.resize(count, refcheck=False)
+  return fields
+
+# Dictionary of the strings that are repeated in most of the records.
+#
+# Hosts, senders, facilities and key names are stored once and every record
+# shares the same object, each one also has a small integer code.
+class StringTable(object):
+
+  def __init__(self):
+    self.codes = {}
+    self.strings = []
+
+  def __len__(self):
+    return len(self.strings)
+
+  # String of a code.
+  def __getitem__(self, code):
+    return self.strings[code]
+
+  # Code of a string, it is added if it is not in the table.
+  def code(self, text):
+    try:
+      return self.codes[text]
+    except KeyError:
+      code = len(self.strings)
+      self.codes[text] = code
+      self.strings.append(text)
+      return code
+
+  # The shared object of a string.
+  def intern(self, text):
+    return self.strings[self.code(text)]
+
+  # Replace the repeated values of a record by their shared objects.
+  #
+  # Args:
+  #  values: raw values of a record, as decodeValues returns them. Host,
+  #          sender, facility and key names are changed in place, without
+  #          the ending nulls.
+  def internValues(self, values):
+    for position in range(min(3, len(values))):
+      values[position] = self.intern(values[position].partition('\x00')[0])
+    for position in range(4, len(values) - 1, 2):
+      values[position] = self.intern(values[position].partition('\x00')[0])
+    return values
+
+# Record of an ASL file for the users of this module.
+#
+# The fixed fields of the Record_Struct are attributes. The values (host,
+# sender, facility, message and the extra key/value pairs) are decoded from
+# the mapped file the first time one of them is used. With a StringTable, the
+# host, sender, facility and key names of all the records are shared objects.
+class ASLRecord(object):
+
+  __slots__ = ASLRecordHeader._fields + (
+      'offset', '_data', '_heap_start', '_cache', '_strings', '_values')
+
+  def __init__(self, offset, record_header, data, heap_start=0, cache=None,
+               strings=None):
+    self.offset = offset
+    (self.tam_entry, self.next_offset, self.ASLMessageID, self.timestamp,
+     self.nanosec, self.level, self.flags, self.pid, self.uid, self.gid,
+     self.read_uid, self.read_gid, self.ref_pid) = record_header
+    self._data = data
+    self._heap_start = heap_start
+    self._cache = cache
+    self._strings = strings
+    self._values = None
+
+  # Raw values, as printRecord expects them.
+  @property
+  def values(self):
+    if self._values is None:
+      self._values = decodeValues(
+          self._data, self.offset + ASL_RECORD_HEADER.size,
+          self.tam_entry - ASL_RECORD_HEADER.size - 2, self._heap_start,
+          self._cache)
+      if self._strings is not None:
+        self._strings.internValues(self._values)
+    return self._values
+
+  # Text of a value without the ending nulls, None if it does not exist.
+  def _text(self, position):
+    values = self.values
+    if position < len(values):
+      return values[position].partition('\x00')[0]
+    return None
+
+  @property
+  def host(self):
+    return self._text(0)
+
+  @property
+  def sender(self):
+    return self._text(1)
+
+  @property
+  def facility(self):
+    return self._text(2)
+
+  @property
+  def message(self):
+    return self._text(3)
+
+  # Decode only some values, without decoding the rest of the record.
+  #
+  # Args:
+  #  keys: names from ASL_FIXED_KEYS or extra key names.
+  # Returns:
+  #  A dictionary with the text of each key that the record has.
+  def project(self, *keys):
+    values = projectValues(
+        self._data, self.offset + ASL_RECORD_HEADER.size,
+        self.tam_entry - ASL_RECORD_HEADER.size - 2, set(keys),
+        self._heap_start, self._cache)
+    values = dict((key, value.partition('\x00')[0])
+                  for key, value in values.items())
+    if self._strings is not None:
+      for key in ('Host', 'Sender', 'Facility'):
+        if key in values:
+          values[key] = self._strings.intern(values[key])
+    return values
+
+  # List of (key, value) with the extra fields of the record.
+  @property
+  def extra(self):
+    values = self.values
+    return [(values[cont].partition('\x00')[0],
+             values[cont + 1].partition('\x00')[0])
+            for cont in range(4, len(values) - 1, 2)]
+
+# Read the records of an ASL file.
+#
+# The file stays mapped while there are records that use it, the values are
+# only decoded when they are requested.
+#
+# Args:
+#  path: the ASL file.
+#  cache_size: size of the HeapStringCache shared by the records, 0 to not
+#              use it.
+#  reverse: from the newest record to the oldest one.
+#  match: optional predicate over the Record_Struct (see buildFilter), the
+#         records that do not match are skipped before reading any value.
+#  strings: optional StringTable shared by the records, it can be shared
+#           between files too.
+#
+# Yields:
+#  ASLRecord objects in the order of the record chain.
+#
+# Raises:
+#  IOError: if the file can not be read.
+#  ValueError: if it is not an ASL file.
+def readRecords(path, cache_size=ASL_CACHE_SIZE, reverse=False, match=None,
+                strings=None):
+  data, header = openASLFile(path)
+  cache = None
+  if cache_size > 0:
+    cache = HeapStringCache(data, cache_size)
+
+  if reverse:
+    offset = header.last_offset
+    while offset >= header.offset and offset:
+      heap_start, previous = recordHeapStart(data, header, offset)
+      record_header = decodeRecordHeader(data, offset)
+      if not match or match(record_header):
+        yield ASLRecord(
+            offset, record_header, data, heap_start, cache, strings)
+      if previous is None:
+        break
+      offset = previous
+    return
+
+  heap_start = ASL_HEADER_STRUCT.sizeof()
+  for offset, record_header in walkRecordHeaders(data, header):
+    if not match or match(record_header):
+      yield ASLRecord(
+          offset, record_header, data, heap_start, cache, strings)
+    heap_start = offset + record_header.tam_entry + 6
+
+# Time index of an ASL file saved next to it.
+#
+# Both tables are read from the mapped index with binary searches, the
+# index is never loaded in memory.
+class ASLTimeIndex(object):
+
+  def __init__(self, data):
+    self.data = data
+    _, self.file_size, self.last_offset, self.count = (
+        ASL_INDEX_HEADER.unpack_from(data, 0))
+    self.time_table = ASL_INDEX_HEADER.size
+    self.id_table = self.time_table + self.count * ASL_INDEX_ENTRY.size
+
+  # First entry of a table whose first field is not lower than key.
+  def _lowerBound(self, table, key):
+    low = 0
+    high = self.count
+    while low < high:
+      middle = (low + high) // 2
+      value, _, _ = ASL_INDEX_ENTRY.unpack_from(
+          self.data, table + middle * ASL_INDEX_ENTRY.size)
+      if value < key:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  # Records between two timestamps (both included, None is unbounded).
+  #
+  # Yields:
+  #  (timestamp, offset) sorted by time.
+  def timeRange(self, since=None, until=None):
+    entry = 0
+    if since is not None:
+      entry = self._lowerBound(self.time_table, since)
+    while entry < self.count:
+      timestamp, _, offset = ASL_INDEX_ENTRY.unpack_from(
+          self.data, self.time_table + entry * ASL_INDEX_ENTRY.size)
+      if until is not None and timestamp > until:
+        break
+      yield timestamp, offset
+      entry += 1
+
+  # Records with a ASLMessageID.
+  #
+  # Yields:
+  #  (timestamp, offset) sorted by time.
+  def messageId(self, message_id):
+    entry = self._lowerBound(self.id_table, message_id)
+    while entry < self.count:
+      entry_id, timestamp, offset = ASL_INDEX_ENTRY.unpack_from(
+          self.data, self.id_table + entry * ASL_INDEX_ENTRY.size)
+      if entry_id != message_id:
+        break
+      yield timestamp, offset
+      entry += 1
+
+# Build the time index of an ASL file in one pass over the records.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#  path: where the index is saved, None to only keep it in memory.
+#
+# Returns:
+#  An ASLTimeIndex.
+def buildTimeIndex(data, header, path=None):
+  entries = []
+  for offset, record_header in walkRecordHeaders(data, header):
+    entries.append(
+        (record_header.timestamp, record_header.ASLMessageID, offset))
+  entries.sort()
+  index = [ASL_INDEX_HEADER.pack(
+      ASL_INDEX_MAGIC, len(data), header.last_offset, len(entries))]
+  for timestamp, message_id, offset in entries:
+    index.append(ASL_INDEX_ENTRY.pack(timestamp, message_id, offset))
+  entries.sort(key=lambda entry: (entry[1], entry[0]))
+  for timestamp, message_id, offset in entries:
+    index.append(ASL_INDEX_ENTRY.pack(message_id, timestamp, offset))
+  index = ''.join(index)
+  if path:
+    try:
+      with open(path, 'wb') as index_file:
+        index_file.write(index)
+    except IOError:
+      sys.stderr.write(
+          '[WARNING] Unable to save the index in {}.\n'.format(path))
+  return ASLTimeIndex(index)
+
+# Open the time index of an ASL file.
+#
+# Args:
+#  path: where the index is saved.
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#
+# Returns:
+#  An ASLTimeIndex, or None if there is no index or it belongs to another
+#  version of the file.
+def openTimeIndex(path, data, header):
+  try:
+    with open(path, 'rb') as index_file:
+      index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError):
+    return None
+  if (len(index) < ASL_INDEX_HEADER.size or
+      index[:len(ASL_INDEX_MAGIC)] != ASL_INDEX_MAGIC):
+    return None
+  index = ASLTimeIndex(index)
+  if (index.file_size != len(data) or
+      index.last_offset != header.last_offset or
+      len(index.data) != index.id_table + index.count * ASL_INDEX_ENTRY.size):
+    return None
+  return index
+
+# Trigram index of the text of an ASL file saved next to it.
+#
+# As ASLTimeIndex, it is read from the mapped index with binary searches, only
+# the postings of the trigrams of a query are loaded.
+class ASLTextIndex(object):
+
+  def __init__(self, data):
+    self.data = data
+    _, self.file_size, self.last_offset, self.records, self.trigrams = (
+        ASL_TEXT_HEADER.unpack_from(data, 0))
+    self.record_table = ASL_TEXT_HEADER.size
+    self.trigram_table = (
+        self.record_table + self.records * ASL_TEXT_RECORD.size)
+    self.postings = (
+        self.trigram_table + self.trigrams * ASL_TEXT_TRIGRAM.size)
+
+  # Sorted record numbers with a trigram.
+  def _postings(self, trigram):
+    low = 0
+    high = self.trigrams
+    while low < high:
+      middle = (low + high) // 2
+      entry, start, count = ASL_TEXT_TRIGRAM.unpack_from(
+          self.data, self.trigram_table + middle * ASL_TEXT_TRIGRAM.size)
+      if entry < trigram:
+        low = middle + 1
+      elif entry > trigram:
+        high = middle
+      else:
+        postings = array.array(ASL_TEXT_POSTING)
+        start += self.postings
+        postings.fromstring(
+            self.data[start:start + count * postings.itemsize])
+        if sys.byteorder == 'little':
+          postings.byteswap()
+        return postings
+    return array.array(ASL_TEXT_POSTING)
+
+  # Records that can have a text, the search is not case sensitive.
+  #
+  # All the trigrams of the text must be in the record, so it can contain
+  # them but not the text itself; searchText checks the values.
+  #
+  # Returns:
+  #  A sorted list with the offsets of the records.
+  def search(self, text):
+    text = text.lower()
+    trigrams = set(text[position:position + 3]
+                   for position in range(len(text) - 2))
+    if trigrams:
+      postings = sorted((self._postings(trigram) for trigram in trigrams),
+                        key=len)
+      numbers = set(postings[0])
+      for posting in postings[1:]:
+        if not numbers:
+          break
+        numbers.intersection_update(posting)
+    else:
+      # Shorter than a trigram, every record has to be checked.
+      numbers = range(self.records)
+    return [ASL_TEXT_RECORD.unpack_from(
+                self.data, self.record_table + number * ASL_TEXT_RECORD.size)[0]
+            for number in sorted(numbers)]
+
+# Build the text index of an ASL file in one pass over the records.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#  path: where the index is saved, None to only keep it in memory.
+#  cache: optional HeapStringCache.
+#
+# Returns:
+#  An ASLTextIndex.
+def buildTextIndex(data, header, path=None, cache=None):
+  offsets = []
+  trigrams = collections.defaultdict(lambda: array.array(ASL_TEXT_POSTING))
+  for offset, _, values in walkRecords(data, header, cache=cache):
+    number = len(offsets)
+    offsets.append(offset)
+    record_trigrams = set()
+    for position, value in enumerate(values):
+      # Key names are not searched.
+      if position >= len(ASL_FIXED_KEYS) and position % 2 == 0:
+        continue
+      value = value.partition('\x00')[0].lower()
+      for start in xrange(len(value) - 2):
+        record_trigrams.add(value[start:start + 3])
+    for trigram in record_trigrams:
+      trigrams[trigram].append(number)
+  index = [ASL_TEXT_HEADER.pack(
+      ASL_TEXT_MAGIC, len(data), header.last_offset, len(offsets),
+      len(trigrams))]
+  for offset in offsets:
+    index.append(ASL_TEXT_RECORD.pack(offset))
+  postings = []
+  start = 0
+  for trigram in sorted(trigrams):
+    posting = trigrams[trigram]
+    index.append(ASL_TEXT_TRIGRAM.pack(trigram, start, len(posting)))
+    if sys.byteorder == 'little':
+      posting.byteswap()
+    postings.append(posting.tostring())
+    start += len(postings[-1])
+  index.extend(postings)
+  index = ''.join(index)
+  if path:
+    try:
+      with open(path, 'wb') as index_file:
+        index_file.write(index)
+    except IOError:
+      sys.stderr.write(
+          '[WARNING] Unable to save the index in {}.\n'.format(path))
+  return ASLTextIndex(index)
+
+# Open the text index of an ASL file.
+#
+# Args:
+#  path: where the index is saved.
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#
+# Returns:
+#  An ASLTextIndex, or None if there is no index or it belongs to another
+#  version of the file.
+def openTextIndex(path, data, header):
+  try:
+    with open(path, 'rb') as index_file:
+      index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError):
+    return None
+  if (len(index) < ASL_TEXT_HEADER.size or
+      index[:len(ASL_TEXT_MAGIC)] != ASL_TEXT_MAGIC):
+    return None
+  index = ASLTextIndex(index)
+  if (index.file_size != len(data) or
+      index.last_offset != header.last_offset or
+      len(index.data) < index.postings):
+    return None
+  return index
+
+# Records with a text in any of their values, not case sensitive.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#  index: its ASLTextIndex.
+#  text: the searched text.
+#  cache: optional HeapStringCache.
+#  match: optional predicate over the Record_Struct (see buildFilter).
+#
+# Yields:
+#  (pos, record_header, values) in the order of the record chain.
+def searchText(data, header, index, text, cache=None, match=None):
+  text = text.lower()
+  for offset, record_header, values in readRecordsAt(
+      data, header, index.search(text), cache=cache, match=match):
+    if values is None:
+      continue
+    for position, value in enumerate(values):
+      if position >= len(ASL_FIXED_KEYS) and position % 2 == 0:
+        continue
+      if text in value.partition('\x00')[0].lower():
+        yield offset, record_header, values
+        break
+
+# Open and map an ASL file.
+#
+# Args:
+#  path: the ASL file.
+#
+# Returns:
+#  (data, header): the memory mapped file and its ASL_HEADER_STRUCT.
+#
+# Raises:
+#  IOError: if the file can not be read.
+#  ValueError: if it is not an ASL file.
+def openASLFile(path):
+  with open(path, 'rb') as f:
+    try:
+      header = ASL_HEADER_STRUCT.parse_stream(f)
+    except construct.ConstructError:
+      raise ValueError('It is not a ASL file, ASL Header not valid.')
+    if header.magic != ASL_MAGIC:
+      raise ValueError('It is not a ASL file, ASL_MAGIC invalid.')
+    # The whole file is mapped, every value is read from where it is.
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  return data, header
+
+# ASL files of a store directory, like /private/var/log/asl.
+#
+# Returns:
+#  A sorted list with the paths.
+def findStoreFiles(directory):
+  paths = []
+  for root, _, names in os.walk(directory):
+    for name in names:
+      if name.endswith(ASL_FILE_EXTENSION):
+        paths.append(os.path.join(root, name))
+  return sorted(paths)
+
+# Time span of the records of a store file according to its name.
+#
+# Returns:
+#  (first, last) timestamps, None if there is no limit.
+def storeFileSpan(path):
+  name = ASL_STORE_FILE_NAME.match(os.path.basename(path))
+  if not name:
+    return None, None
+  try:
+    day = calendar.timegm(
+        (int(name.group(2)), int(name.group(3)), int(name.group(4)),
+         0, 0, 0, 0, 0, 0))
+  except ValueError:
+    return None, None
+  last = day + 24 * 3600 + ASL_STORE_TIME_SLACK
+  # Long-lived files: the date is when they expire, not when they were written.
+  if name.group(1):
+    return None, last
+  return day - ASL_STORE_TIME_SLACK, last
+
+# Next ASLMessageID of a store, from its StoreData file.
+#
+# Returns:
+#  The ASLMessageID, or None if there is no valid StoreData.
+def readStoreData(directory):
+  try:
+    with open(os.path.join(directory, ASL_STORE_DATA), 'rb') as store_data:
+      next_id, = ASL_STORE_DATA_STRUCT.unpack(
+          store_data.read(ASL_STORE_DATA_STRUCT.size))
+  except (EnvironmentError, struct.error):
+    return None
+  return next_id
+
+# Skip the files of a store that can not have records in a time window.
+#
+# Nothing but the names, StoreData and the ASL headers is read. A file is
+# skipped if the day in its name is out of the window, or if it was created
+# (timestamp of its header) after the end of the window. The files that can
+# not be checked are kept, parseStore reports them.
+#
+# Args:
+#  directory: the store directory.
+#  paths: its ASL files, see findStoreFiles.
+#  since, until: timestamps, None if there is no limit.
+#  message_id: ASLMessageID, None for any.
+#
+# Returns:
+#  The paths that can have records in the window.
+def pruneStoreFiles(directory, paths, since=None, until=None,
+                    message_id=None):
+  if message_id is not None:
+    next_id = readStoreData(directory)
+    # The message was never written in this store.
+    if next_id is not None and message_id >= next_id:
+      return []
+  if since is None and until is None:
+    return paths
+  kept = []
+  for path in paths:
+    first, last = storeFileSpan(path)
+    if since is not None and last is not None and last < since:
+      continue
+    if until is not None and first is not None and first > until:
+      continue
+    if until is not None:
+      try:
+        with open(path, 'rb') as f:
+          header = ASL_HEADER_STRUCT.parse_stream(f)
+        if header.magic == ASL_MAGIC and header.timestamp > until:
+          continue
+      except (EnvironmentError, construct.ConstructError):
+        pass
+    kept.append(path)
+  return kept
+
+# Parse one file of a store and save its records in a temporary file.
+#
+# It runs in the worker processes of parseStore, the records are written
+# with marshal in the order of the next_offset chain.
+#
+# Args:
+#  task: (number, path, spill, decoder, filters, keys, budget, cache_size),
+#        number identifies the file, spill is where its records are written,
+#        filters are the arguments of buildFilter, keys the ones of
+#        projectValues, budget the ones of setMemoryBudget and cache_size
+#        the size of the HeapStringCache, 0 disables it.
+#
+# Returns:
+#  (number, number of records, error message or None, stopped): the records
+#  read before an error are kept, stopped is True if the decoder stopped the
+#  program (the verify decoder, when the decoders disagree).
+def parseStoreFile(task):
+  number, path, spill, decoder, filters, keys, budget, cache_size = task
+  setMemoryBudget(*budget)
+  try:
+    data, header = openASLFile(path)
+  except (EnvironmentError, ValueError) as exception:
+    return number, 0, str(exception), False
+  cache = None
+  if cache_size > 0 and decoder == 'struct':
+    cache = HeapStringCache(data, cache_size)
+  records = 0
+  match = buildFilter(**filters)
+  try:
+    with open(spill, 'wb') as spill_file:
+      for offset, record_header, values in walkRecords(
+          data, header, decoder, cache, match=match, keys=keys):
+        if values is None:
+          continue
+        fields = tuple(getattr(record_header, field)
+                       for field in ASLRecordHeader._fields)
+        marshal.dump((record_header.timestamp, record_header.nanosec, number,
+                      offset, fields, values), spill_file)
+        records += 1
+  except SystemExit:
+    # The decoder already printed the reason.
+    sys.stdout.flush()
+    return number, records, 'stopped by the {} decoder'.format(decoder), True
+  except struct.error as exception:
+    return number, records, str(exception), False
+  finally:
+    data.close()
+  return number, records, None, False
+
+# Read back the records saved by parseStoreFile.
+def readSpill(path):
+  with open(path, 'rb') as spill_file:
+    while True:
+      try:
+        yield marshal.load(spill_file)
+      except EOFError:
+        return
+
+# Parse all the files of an ASL store as one stream sorted by time.
+#
+# The files are parsed in a process pool and the records of each one are
+# merged with a heap (k-way merge). Each file keeps its own order, the one of
+# its next_offset chain, which is the order in which syslogd wrote them.
+# Only one record per file is in memory during the merge.
+#
+# Args:
+#  paths: the ASL files.
+#  processes: size of the process pool, None uses all the CPUs.
+#  decoder: one of ASL_DECODERS.
+#  filters: dictionary with the arguments of buildFilter.
+#  keys: optional set of keys to decode (see projectValues).
+#  cache_size: size of the HeapStringCache of each file, 0 disables it.
+#
+# Yields:
+#  (path, pos, record_header, values) sorted by timestamp and nanosec.
+def parseStore(paths, processes=None, decoder='struct', filters=None,
+               keys=None, cache_size=ASL_CACHE_SIZE):
+  spill_dir = tempfile.mkdtemp(prefix='asl_store_')
+  try:
+    tasks = []
+    for number, path in enumerate(paths):
+      tasks.append((number, path, os.path.join(spill_dir, str(number)),
+                    decoder, filters or {}, keys,
+                    (max_value_size, max_record_size), cache_size))
+    pool = multiprocessing.Pool(processes)
+    try:
+      results = pool.map(parseStoreFile, tasks, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+
+    streams = []
+    for number, records, error, stopped in results:
+      if stopped:
+        exit(1)
+      if error and not records:
+        sys.stderr.write('[WARNING] Skipping {}: {}\n'.format(
+            paths[number], error))
+      elif error:
+        sys.stderr.write(
+            '[WARNING] Only the first {} records of {}: {}\n'.format(
+                records, paths[number], error))
+      if records:
+        streams.append(readSpill(tasks[number][2]))
+    for _, _, number, offset, fields, values in heapq.merge(*streams):
+      yield paths[number], offset, ASLRecordHeader._make(fields), values
+  finally:
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+# Build a predicate over the fixed fields of the records (Record_Struct).
+#
+# The walkers evaluate it before the values of a record are decoded, so the
+# records that do not match only cost the unpack of their Record_Struct.
+#
+# Args:
+#  since, until: timestamps, None if there is no limit.
+#  message_id: ASLMessageID, None for any.
+#  levels, pids, uids, gids: sets of accepted values, None for any.
+#
+# Returns:
+#  A function that returns True if a record_header matches, or None if there
+#  is nothing to filter.
+def buildFilter(since=None, until=None, message_id=None, levels=None,
+                pids=None, uids=None, gids=None):
+  checks = []
+  if since is not None:
+    checks.append(lambda record_header: record_header.timestamp >= since)
+  if until is not None:
+    checks.append(lambda record_header: record_header.timestamp <= until)
+  if message_id is not None:
+    checks.append(
+        lambda record_header: record_header.ASLMessageID == message_id)
+  if levels:
+    checks.append(lambda record_header: record_header.level in levels)
+  if pids:
+    checks.append(lambda record_header: record_header.pid in pids)
+  if uids:
+    checks.append(lambda record_header: record_header.uid in uids)
+  if gids:
+    checks.append(lambda record_header: record_header.gid in gids)
+  if not checks:
+    return None
+  if len(checks) == 1:
+    return checks[0]
+  def match(record_header):
+    for check in checks:
+      if not check(record_header):
+        return False
+    return True
+  return match
+
+# Writer of the archives of parsed records (see ASL_ARCHIVE_MAGIC).
+#
+# The records are kept in memory until a block is full, then the block is
+# compressed and written. The values are saved without their ending nulls.
+class ASLArchiveWriter(object):
+
+  def __init__(self, path):
+    self.file = open(path, 'wb')
+    self.file.write(ASL_ARCHIVE_MAGIC)
+    self.strings = StringTable()
+    self.records = 0
+    # Strings of the table already written.
+    self._written = 0
+    self._fields = []
+    self._codes = array.array(ASL_ARCHIVE_CODE)
+    self._values = []
+
+  # Add a record.
+  #
+  # Args:
+  #  offset: where the record was in its file.
+  #  record_header: its ASLRecordHeader, or the Container of the reference
+  #                 decoders.
+  #  values: its raw values, as decodeValues returns them.
+  def add(self, offset, record_header, values):
+    fields = tuple(getattr(record_header, field)
+                   for field in ASLRecordHeader._fields)
+    self._fields.append(ASL_ARCHIVE_RECORD.pack(
+        *(fields + (offset, len(values)))))
+    for position, value in enumerate(values):
+      value = value.partition('\x00')[0]
+      if position == 3:
+        # The message: its template and its variable parts.
+        if ASL_ARCHIVE_PARAMETER in value:
+          template = ASL_ARCHIVE_PARAMETER
+          self._values.append(value)
+        else:
+          template = ASL_ARCHIVE_VARIABLE.sub(ASL_ARCHIVE_PARAMETER, value)
+          self._values.extend(ASL_ARCHIVE_VARIABLE.findall(value))
+        self._codes.append(self.strings.code(template))
+      elif position < 3 or position % 2 == 0:
+        self._codes.append(self.strings.code(value))
+      else:
+        self._values.append(value)
+    self.records += 1
+    if len(self._fields) >= ASL_ARCHIVE_BLOCK_RECORDS:
+      self._flush()
+
+  def _flush(self):
+    if not self._fields:
+      return
+    new_strings = '\x00'.join(self.strings.strings[self._written:])
+    block = [ASL_ARCHIVE_BLOCK.pack(
+        len(self._fields), len(self.strings) - self._written,
+        len(new_strings), len(self._codes), len(self._values)), new_strings]
+    block.extend(self._fields)
+    if sys.byteorder == 'little':
+      self._codes.byteswap()
+    block.append(self._codes.tostring())
+    block.append('\x00'.join(self._values))
+    block = zlib.compress(''.join(block))
+    self.file.write(ASL_ARCHIVE_LENGTH.pack(len(block)))
+    self.file.write(block)
+    self._written = len(self.strings)
+    self._fields = []
+    self._codes = array.array(ASL_ARCHIVE_CODE)
+    self._values = []
+
+  def close(self):
+    self._flush()
+    self.file.close()
+
+# Read the records of an archive.
+#
+# Args:
+#  path: the archive, written by ASLArchiveWriter.
+#  match: optional predicate over the Record_Struct (see buildFilter).
+#
+# Yields:
+#  (pos, record_header, values) as walkRecords, the values without their
+#  ending nulls.
+#
+# Raises:
+#  ValueError: if it is not an archive.
+#  zlib.error: if a block is corrupted.
+def readArchive(path, match=None):
+  strings = []
+  # Parts of each template around its variable parts, by code.
+  templates = {}
+  with open(path, 'rb') as archive:
+    if archive.read(len(ASL_ARCHIVE_MAGIC)) != ASL_ARCHIVE_MAGIC:
+      raise ValueError('It is not an ASL archive.')
+    while True:
+      length = archive.read(ASL_ARCHIVE_LENGTH.size)
+      if len(length) < ASL_ARCHIVE_LENGTH.size:
+        return
+      length, = ASL_ARCHIVE_LENGTH.unpack(length)
+      block = zlib.decompress(archive.read(length))
+      records, new, strings_size, codes_count, values_count = (
+          ASL_ARCHIVE_BLOCK.unpack_from(block, 0))
+      pos = ASL_ARCHIVE_BLOCK.size
+      if new:
+        strings.extend(block[pos:pos + strings_size].split('\x00'))
+      pos += strings_size
+      fields = pos
+      pos += records * ASL_ARCHIVE_RECORD.size
+      codes = array.array(ASL_ARCHIVE_CODE)
+      codes.fromstring(block[pos:pos + codes_count * codes.itemsize])
+      if sys.byteorder == 'little':
+        codes.byteswap()
+      values_list = []
+      if values_count:
+        values_list = block[pos + codes_count * codes.itemsize:].split('\x00')
+      code = 0
+      value = 0
+      for record in xrange(records):
+        fields_record = ASL_ARCHIVE_RECORD.unpack_from(
+            block, fields + record * ASL_ARCHIVE_RECORD.size)
+        record_header = ASLRecordHeader._make(fields_record[:-2])
+        values = []
+        for position in xrange(fields_record[-1]):
+          if position == 3:
+            parts = templates.get(codes[code])
+            if parts is None:
+              parts = strings[codes[code]].split(ASL_ARCHIVE_PARAMETER)
+              templates[codes[code]] = parts
+            code += 1
+            message = [parts[0]]
+            for part in parts[1:]:
+              message.append(values_list[value])
+              message.append(part)
+              value += 1
+            values.append(''.join(message))
+          elif position < 3 or position % 2 == 0:
+            values.append(strings[codes[code]])
+            code += 1
+          else:
+            values.append(values_list[value])
+            value += 1
+        if match is None or match(record_header):
+          yield fields_record[-2], record_header, values
+
+# Streaming counters of a group of records.
+#
+# Levels, PIDs, senders and hours are counted exactly, their memory grows with
+# the number of distinct values. The messages are almost all different, they
+# are counted with the Misra-Gries algorithm in at most 2 * capacity entries:
+# when it is full, the smallest counts are discarded and their maximum is
+# subtracted from all the others, so a count can be lower than the real one
+# by at most message_error.
+class ASLStats(object):
+
+  def __init__(self, capacity=10 * ASL_STATS_TOP):
+    self.records = 0
+    self.first = None
+    self.last = None
+    self.levels = collections.Counter()
+    self.pids = collections.Counter()
+    self.senders = collections.Counter()
+    self.hours = collections.Counter()
+    self.messages = collections.Counter()
+    self.message_error = 0
+    self.capacity = capacity
+
+  # Count a record.
+  #
+  # Args:
+  #  record_header: its ASLRecordHeader.
+  #  values: dictionary with the raw values of ASL_STATS_KEYS, as
+  #          projectValues returns them.
+  def add(self, record_header, values):
+    timestamp = record_header.timestamp
+    self.records += 1
+    if self.first is None or timestamp < self.first:
+      self.first = timestamp
+    if self.last is None or timestamp > self.last:
+      self.last = timestamp
+    self.levels[record_header.level] += 1
+    self.pids[record_header.pid] += 1
+    self.hours[timestamp - timestamp % 3600] += 1
+    self.senders[values.get('Sender', '').partition('\x00')[0]] += 1
+    self.messages[values.get('Message', '').partition('\x00')[0]] += 1
+    if len(self.messages) > 2 * self.capacity:
+      counts = sorted(self.messages.itervalues(), reverse=True)
+      discount = counts[self.capacity]
+      self.message_error += discount
+      for message, count in self.messages.items():
+        if count <= discount:
+          del self.messages[message]
+        else:
+          self.messages[message] = count - discount
+
+  # Print the report.
+  #
+  # Args:
+  #  top: number of senders, PIDs and messages listed.
+  def printReport(self, top=ASL_STATS_TOP):
+    print '\nASL statistics: {} records.'.format(self.records)
+    if not self.records:
+      return
+    print ' From {} to {} (UTC).'.format(
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.first)),
+        time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.last)))
+    print ' Levels:'
+    for level, count in sorted(self.levels.items()):
+      print '\t{}: {}'.format(
+          ASL_MESSAGE_PRIORITY.get(level, level), count)
+    printCounts(' Senders', self.senders, top)
+    printCounts(' PIDs', self.pids, top)
+    print ' Records per hour (UTC):'
+    for hour, count in sorted(self.hours.items()):
+      print '\t{}: {}'.format(
+          time.strftime('%Y-%m-%d %H:00', time.gmtime(hour)), count)
+    if self.message_error:
+      print ' Messages (each count can be up to {} lower):'.format(
+          self.message_error)
+    else:
+      print ' Messages:'
+    for message, count in self.messages.most_common(top):
+      print '\t{}: {}'.format(count, message)
+
+# Print the most common values of a counter.
+#
+# Args:
+#  title: name of the list.
+#  counter: a collections.Counter.
+#  top: number of values printed, the rest are only counted.
+def printCounts(title, counter, top):
+  print '{} ({} distinct):'.format(title, len(counter))
+  for value, count in counter.most_common(top):
+    print '\t{}: {}'.format(value, count)
+  if len(counter) > top:
+    print '\t... {} more.'.format(len(counter) - top)
+
+# Wait for new records in a live ASL file, like "tail -f".
+#
+# Every interval the file is mapped again if it has grown and its header is
+# read again. The walk continues from the next_offset of the last record that
+# was read, so the old records are never decoded again.
+#
+# Args:
+#  path: the ASL file.
+#  last: offset of the last record already read, None if there was none.
+#  decoder: one of ASL_DECODERS.
+#  cache: optional HeapStringCache, it is kept between polls.
+#  interval: seconds between polls.
+#  match: optional predicate over the Record_Struct (see buildFilter).
+#  keys: optional set of keys to decode (see projectValues).
+#
+# Yields:
+#  (pos, record_header, values) of the new records, forever. values is None
+#  for the records that do not match.
+def followRecords(path, last=None, decoder='struct', cache=None,
+                  interval=1.0, match=None, keys=None):
+  data = None
+  while True:
+    time.sleep(interval)
+    try:
+      size = os.path.getsize(path)
+    except OSError:
+      continue
+    if data is None or size != len(data):
+      shrunk = data is not None and size < len(data)
+      if shrunk:
+        sys.stderr.write(
+            '[WARNING] {} is smaller, reading it from the start.\n'.format(
+                path))
+        last = None
+      try:
+        new_data, header = openASLFile(path)
+      except (EnvironmentError, ValueError):
+        continue
+      if data is not None:
+        data.close()
+      if cache is not None:
+        # The offsets of a smaller file point to other strings.
+        if shrunk:
+          cache.clear()
+        cache.data = new_data
+      data = new_data
+    else:
+      header = ASL_HEADER_STRUCT.parse(data[:ASL_HEADER_STRUCT.sizeof()])
+
+    if last is None:
+      start = header.offset
+      # Still without records.
+      if not start:
+        continue
+    else:
+      start = decodeRecordHeader(data, last).next_offset
+      # Still the last record of the file.
+      if start <= last:
+        continue
+    try:
+      for offset, record_header, values in walkRecords(
+          data, header, decoder, cache, start, match, keys):
+        last = offset
+        yield offset, record_header, values
+    except struct.error:
+      # The record is still being written, it is read in the next poll.
+      pass
+
+# Validate a candidate record found by ASL_CARVE_PATTERN.
+#
+# Args:
+#  data: the memory mapped image.
+#  pos: where the candidate Record_Struct starts.
+#
+# Returns:
+#  (record_header, previous offset) or None if it is not a record.
+def carveRecordHeader(data, pos):
+  if data[pos] != '\x00':
+    return None
+  record_header = decodeRecordHeader(data, pos)
+  tam_entry = record_header.tam_entry
+  if (tam_entry < ASL_RECORD_MIN_ENTRY or
+      (tam_entry - ASL_RECORD_MIN_ENTRY) % ASL_RECORD_SLOT.size or
+      pos + tam_entry + 6 > len(data) or
+      record_header.nanosec >= 1000000000):
+    return None
+  # Every slot is empty, text or a pointer inside a file, and so it is the
+  # offset of the previous record at the end.
+  slot = pos + ASL_RECORD_HEADER.size
+  end = pos + tam_entry - 2
+  while slot <= end:
+    addr_txt, = ASL_RECORD_SLOT.unpack_from(data, slot)
+    if addr_txt >> 32 and addr_txt & ASL_SLOT_TEXT_MASK != ASL_SLOT_TEXT:
+      return None
+    slot += ASL_RECORD_SLOT.size
+  if addr_txt >> 32:
+    return None
+  return record_header, addr_txt
+
+# Decode the values of a carved record.
+#
+# Args:
+#  data: the memory mapped image.
+#  pos: where the Record_Struct starts.
+#  record_header: its ASLRecordHeader.
+#  base: where its ASL file starts in the image, None if it is unknown.
+#
+# Returns:
+#  A list with the raw values, or None if they point outside of the image,
+#  to something that is not a dynamic value or base is needed and unknown.
+def carveValues(data, pos, record_header, base):
+  values = []
+  slot = pos + ASL_RECORD_HEADER.size
+  end = pos + record_header.tam_entry - 2
+  while slot < end:
+    addr_txt, = ASL_RECORD_SLOT.unpack_from(data, slot)
+    if addr_txt:
+      if addr_txt & ASL_SLOT_TEXT_MASK == ASL_SLOT_TEXT:
+        values.append(data[slot + 1:slot + 8])
+      else:
+        if base is None:
+          return None
+        addr = base + addr_txt
+        if (addr + 6 > len(data) or
+            data[addr:addr + 2] != ASL_DYN_VALUE_TYPE):
+          return None
+        length, = ASL_DYN_VALUE_LENGTH.unpack_from(data, addr + 2)
+        if length > max_value_size or addr + 6 + length > len(data):
+          return None
+        values.append(data[addr + 6:addr + 6 + length])
+    slot += ASL_RECORD_SLOT.size
+  return values
+
+# Carve ASL records from any binary, like a disk image or unallocated space.
+#
+# The image is scanned in chunks with ASL_CARVE_PATTERN and each candidate is
+# validated with carveRecordHeader. The pointers of a record are relative to
+# the start of its ASL file, which is unknown. Two records A and B are
+# consecutive when B points back to A and A points forward to B, that is,
+# when pos(A) + next_offset(A) == pos(B) + previous offset(B), and then the
+# file starts in pos(B) - next_offset(A). A record is yielded as soon as its
+# file is known, the ones that are not linked with any other are yielded at
+# the end, with base None.
+#
+# Args:
+#  data: the memory mapped image.
+#  chunk_size: bytes scanned on each pass.
+#  match: optional predicate over the Record_Struct (see buildFilter).
+#
+# Yields:
+#  (pos, base, record_header, values): pos is where the record is in the
+#  image and base where its ASL file starts, values is None if they can not
+#  be recovered.
+def carveRecords(data, chunk_size=ASL_CARVE_CHUNK, match=None):
+  size = len(data)
+  # pos + next_offset of the records still waiting for the next one.
+  forward = {}
+  # Records without base yet, by position.
+  unlinked = collections.OrderedDict()
+
+  def carved(pos, record_header, base):
+    if match is not None and not match(record_header):
+      return None
+    return (pos, base, record_header,
+            carveValues(data, pos, record_header, base))
+
+  for start in xrange(0, size, chunk_size):
+    end = min(start + chunk_size, size)
+    # The last candidates of the chunk are matched with the next bytes.
+    for found in ASL_CARVE_PATTERN.finditer(
+        data, start + 1, min(end + ASL_RECORD_HEADER.size, size)):
+      pos = found.start() - 1
+      if pos >= end:
+        break
+      candidate = carveRecordHeader(data, pos)
+      if candidate is None:
+        continue
+      record_header, previous = candidate
+      base = None
+      if previous:
+        linked = forward.pop(pos + previous, None)
+        if linked is not None:
+          linked_pos, linked_header = linked
+          base = pos - linked_header.next_offset
+          if base < 0:
+            base = None
+          elif linked_pos in unlinked:
+            del unlinked[linked_pos]
+            record = carved(linked_pos, linked_header, base)
+            if record is not None:
+              yield record
+      if record_header.next_offset:
+        forward[pos + record_header.next_offset] = (pos, record_header)
+      if base is None:
+        unlinked[pos] = record_header
+      else:
+        record = carved(pos, record_header, base)
+        if record is not None:
+          yield record
+  for pos, record_header in unlinked.iteritems():
+    record = carved(pos, record_header, None)
+    if record is not None:
+      yield record
+
+# Result of skimRecords.
+class ASLChainReport(object):
+
+  def __init__(self, header):
+    self.header = header
+    self.records = 0
+    self.first = None
+    self.last = None
+    self.last_record = None
+    # (offset, reason) of each problem found in the chain.
+    self.breaks = []
+    self.loops = 0
+    self.back_pointers = 0
+
+  def printReport(self):
+    print ' Records: {}'.format(self.records)
+    if self.records:
+      print ' From {} to {} (UTC).'.format(
+          time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.first)),
+          time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(self.last)))
+      print ' Last record: {} (header: {})'.format(
+          hex(self.last_record), hex(self.header.last_offset))
+    print ' Wrong pointers to the previous record: {}'.format(
+        self.back_pointers)
+    print ' Loops: {}'.format(self.loops)
+    print ' Chain breaks: {}'.format(len(self.breaks))
+    for offset, reason in self.breaks:
+      print '\t{}: {}'.format(hex(offset), reason)
+
+# Check the record chain of an ASL file without decoding any value.
+#
+# Only tam_entry, next_offset, timestamp and the pointer to the previous
+# record are read at each hop. When the chain is broken, or it goes back to a
+# record already read (a loop), the walk continues in the next record found
+# by resyncRecord, so the count includes the records after the problem.
+#
+# Args:
+#  data: the memory mapped ASL file.
+#  header: the ASL_HEADER_STRUCT of the file.
+#
+# Returns:
+#  An ASLChainReport.
+def skimRecords(data, header):
+  report = ASLChainReport(header)
+  size = len(data)
+  visited = set()
+  previous = 0
+  offset = header.offset
+  while offset:
+    if offset + ASL_RECORD_SKIM.size > size:
+      report.breaks.append((offset, 'record out of the file'))
+      break
+    tam_entry, next_offset, timestamp = ASL_RECORD_SKIM.unpack_from(
+        data, offset)
+    if (tam_entry < ASL_RECORD_HEADER.size + 2 or
+        offset + tam_entry + 6 > size):
+      report.breaks.append((offset, 'tam_entry out of the file'))
+      previous = offset
+      offset = resyncRecord(data, header, offset)
+      continue
+    visited.add(offset)
+    report.records += 1
+    report.last_record = offset
+    if report.first is None or timestamp < report.first:
+      report.first = timestamp
+    if report.last is None or timestamp > report.last:
+      report.last = timestamp
+    back, = ASL_RECORD_SLOT.unpack_from(data, offset + tam_entry - 2)
+    if previous and back != previous:
+      report.back_pointers += 1
+    previous = offset
+    if not next_offset:
+      break
+    if next_offset in visited:
+      report.loops += 1
+      report.breaks.append((offset, 'loop to {}'.format(hex(next_offset))))
+      offset = resyncRecord(data, header, offset)
+      if offset in visited:
+        break
+    elif next_offset <= offset or next_offset > header.last_offset:
+      report.breaks.append(
+          (offset, 'next_offset {} out of the chain'.format(
+              hex(next_offset))))
+      offset = resyncRecord(data, header, offset)
+    else:
+      offset = next_offset
+  if report.last_record is not None and (
+      report.last_record != header.last_offset):
+    report.breaks.append(
+        (report.last_record, 'the chain does not end in the last record'))
+  return report
+
+# Convert a time given in the command line to an epoch timestamp.
+#
+# Args:
+#  text: epoch seconds, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' in UTC, the
+#        same representation printRecord uses.
+#
+# Returns:
+#  The epoch timestamp.
+def parseTime(text):
+  if text.isdigit():
+    return int(text)
+  for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+    try:
+      return calendar.timegm(time.strptime(text, time_format))
+    except ValueError:
+      pass
+  raise argparse.ArgumentTypeError(
+      'invalid time "{}", use epoch or YYYY-MM-DD [HH:MM:SS]'.format(text))
+
+# Convert a comma separated list of the command line to a set of integers.
+def parseIntegers(text):
   try:
-    f = open(log, 'rb')
-  except:
+    return set(int(value) for value in text.split(','))
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        'invalid list "{}", use numbers separated by commas'.format(text))
+
+# Convert the levels of the command line to a set of priorities.
+#
+# Args:
+#  text: comma separated numbers, names (ASL_MESSAGE_PRIORITY) or ranges of
+#        numbers, e.g. "0-3,WARNING".
+def parseLevels(text):
+  names = dict((name, level) for level, name in ASL_MESSAGE_PRIORITY.items())
+  levels = set()
+  for value in text.upper().split(','):
+    first, _, last = value.partition('-')
+    try:
+      if value in names:
+        levels.add(names[value])
+      elif last:
+        levels.update(range(int(first), int(last) + 1))
+      else:
+        levels.add(int(value))
+    except ValueError:
+      raise argparse.ArgumentTypeError(
+          'invalid level "{}", use 0-7 or {}'.format(
+              value, ', '.join(ASL_MESSAGE_PRIORITY.values())))
+  return levels
+
+# Main program
+def __init__():
+  parser = argparse.ArgumentParser(description='Apple System Log parser.')
+  parser.add_argument(
+      'log', metavar='ASLfile',
+      help='ASL file to parse, or a store directory (/private/var/log/asl) '
+           'to parse all its files as one stream sorted by time.')
+  parser.add_argument(
+      '--decoder', choices=ASL_DECODERS, default='struct',
+      help='struct (default), construct (reference implementation) or '
+           'verify (decode with both and stop if they disagree).')
+  parser.add_argument(
+      '--cache-size', type=int, default=ASL_CACHE_SIZE,
+      help='Number of shared heap strings cached, 0 disables the cache '
+           '(default: %(default)s).')
+  parser.add_argument(
+      '--last', type=int, metavar='N',
+      help='Only the N newest records, newest first.')
+  parser.add_argument(
+      '--since', type=parseTime, metavar='TIME',
+      help='Only the records from TIME (UTC). Without --index they are read '
+           'newest first.')
+  parser.add_argument(
+      '--until', type=parseTime, metavar='TIME',
+      help='Only the records up to TIME (UTC).')
+  parser.add_argument(
+      '--message-id', type=int, metavar='ID',
+      help='Only the records with this ASLMessageID.')
+  parser.add_argument(
+      '--level', type=parseLevels, metavar='LEVELS',
+      help='Only the records with these priority levels: numbers, names or '
+           'ranges separated by commas, e.g. 0-3,WARNING.')
+  parser.add_argument(
+      '--pid', type=parseIntegers, metavar='PIDS',
+      help='Only the records of these PIDs, separated by commas.')
+  parser.add_argument(
+      '--uid', type=parseIntegers, metavar='UIDS',
+      help='Only the records of these UIDs, separated by commas.')
+  parser.add_argument(
+      '--gid', type=parseIntegers, metavar='GIDS',
+      help='Only the records of these GIDs, separated by commas.')
+  parser.add_argument(
+      '--keys', metavar='KEYS',
+      help='Only decode and print these values, separated by commas: '
+           '{} or extra keys like ASLSHIM.'.format(', '.join(ASL_FIXED_KEYS)))
+  parser.add_argument(
+      '--index', action='store_true',
+      help='Use the time index of the file to find the records, it is built '
+           'if it does not exist or it is not valid anymore. The records are '
+           'sorted by time.')
+  parser.add_argument(
+      '--index-file', metavar='PATH',
+      help='Where the time index is saved (default: ASLfile{}).'.format(
+          ASL_INDEX_EXTENSION))
+  parser.add_argument(
+      '--search', metavar='TEXT',
+      help='Only the records with TEXT in their values, not case sensitive. '
+           'The trigram index of each file (ASLfile{}) is used, it is built '
+           'if it does not exist or it is not valid anymore.'.format(
+               ASL_TEXT_EXTENSION))
+  parser.add_argument(
+      '--numpy', metavar='PATH',
+      help='Save the fixed fields of the records in a NumPy .npy file '
+           'instead of printing them (needs NumPy).')
+  parser.add_argument(
+      '--skim', action='store_true',
+      help='Only check the record chain: number of records, time span, '
+           'breaks and loops. No value is decoded.')
+  parser.add_argument(
+      '--stats', action='store_true',
+      help='Print statistics of the records (levels, senders, PIDs, records '
+           'per hour and the most common messages) instead of the records.')
+  parser.add_argument(
+      '--top', type=int, default=ASL_STATS_TOP, metavar='N',
+      help='Length of the lists of --stats (default: %(default)s).')
+  parser.add_argument(
+      '--carve', action='store_true',
+      help='ASLfile is any binary, like a disk image or unallocated space, '
+           'and the records are carved from it.')
+  parser.add_argument(
+      '--max-value-size', type=int, default=ASL_MAX_VALUE_SIZE,
+      metavar='BYTES',
+      help='Records with a bigger value are skipped (default: %(default)s).')
+  parser.add_argument(
+      '--max-record-size', type=int, default=ASL_MAX_RECORD_SIZE,
+      metavar='BYTES',
+      help='Records whose values need more memory are skipped (default: '
+           '%(default)s).')
+  parser.add_argument(
+      '--archive', metavar='PATH',
+      help='Save the records in a compact archive instead of printing them.')
+  parser.add_argument(
+      '--from-archive', action='store_true',
+      help='ASLfile is an archive saved with --archive.')
+  parser.add_argument(
+      '--processes', type=int, metavar='N',
+      help='Worker processes used with a store directory (default: number of '
+           'CPUs).')
+  parser.add_argument(
+      '--follow', action='store_true',
+      help='Keep waiting for new records, like tail -f.')
+  parser.add_argument(
+      '--interval', type=float, default=1.0, metavar='SECONDS',
+      help='Seconds between polls in --follow mode (default: %(default)s).')
+  options = parser.parse_args()
+  if options.last is not None and options.last < 1:
+    parser.error('--last must be a positive number of records.')
+  if options.follow and (options.index or options.last is not None or
+                         os.path.isdir(options.log)):
+    parser.error('--follow reads a single file forward, it can not be used '
+                 'with --index, --last or a directory.')
+  if options.carve and (options.follow or options.index or options.numpy or
+                        options.keys or options.last is not None or
+                        os.path.isdir(options.log)):
+    parser.error('--carve scans a single file and prints all the records.')
+  if options.numpy and (options.follow or options.index or
+                        options.last is not None or os.path.isdir(options.log)):
+    parser.error('--numpy exports a single file in the order of its records.')
+  if options.numpy and numpy is None:
+    parser.error('--numpy needs NumPy.')
+  if options.search is not None and (
+      options.follow or options.index or options.last is not None or
+      options.keys or options.stats or options.carve or options.numpy or
+      options.decoder != 'struct'):
+    parser.error('--search can only be used with the filters.')
+  if options.stats and (options.follow or options.keys or options.carve or
+                        options.numpy):
+    parser.error('--stats can not be used with --follow, --keys, --carve '
+                 'or --numpy.')
+  if options.archive and (options.keys or options.stats or options.follow or
+                          options.carve or options.numpy):
+    parser.error('--archive can not be used with --keys, --stats, --follow, '
+                 '--carve or --numpy.')
+  if options.from_archive and (
+      options.keys or options.follow or options.index or options.search or
+      options.last is not None or options.carve or options.numpy or
+      options.skim):
+    parser.error('--from-archive can only be used with the filters, --stats '
+                 'and --archive.')
+  if (options.keys or options.stats) and options.decoder != 'struct':
+    parser.error('--keys and --stats always use the struct decoder.')
+  setMemoryBudget(options.max_value_size, options.max_record_size)
+  if options.skim:
+    paths = [options.log]
+    if os.path.isdir(options.log):
+      paths = findStoreFiles(options.log)
+    for path in paths:
+      print '\nSkimming the ASL file [{}].'.format(path)
+      try:
+        data, header = openASLFile(path)
+      except (EnvironmentError, ValueError) as exception:
+        print '[Error]{}'.format(exception)
+        continue
+      skimRecords(data, header).printReport()
+      data.close()
+    return
+  log = options.log
+  keys = None
+  if options.keys:
+    keys = [key for key in options.keys.split(',') if key]
+  # The filters are checked before decoding the values of each record.
+  filters = {
+      'since': options.since, 'until': options.until,
+      'message_id': options.message_id, 'levels': options.level,
+      'pids': options.pid, 'uids': options.uid, 'gids': options.gid}
+  match = buildFilter(**filters)
+  project = set(keys) if keys else None
+  stats = None
+  if options.stats:
+    stats = ASLStats()
+    project = set(ASL_STATS_KEYS)
+  archive = None
+  if options.archive:
+    archive = ASLArchiveWriter(options.archive)
+
+  # Print a record, with all its values or only with the requested keys.
+  def output(record_header, values, offset):
+    if stats is not None:
+      stats.add(record_header, values)
+    elif archive is not None:
+      archive.add(offset, record_header, values)
+    elif keys:
+      printProjection(record_header, values, offset, keys)
+    else:
+      printRecord(record_header, values, offset)
+
+  # Report of the modes that do not print each record.
+  def finish():
+    if stats is not None:
+      stats.printReport(options.top)
+    if archive is not None:
+      archive.close()
+      print 'Saved {} records in {}.'.format(archive.records, options.archive)
+
+  if options.from_archive:
+    print '\nReading the ASL archive [{}].'.format(log)
+    try:
+      for offset, record_header, values in readArchive(log, match):
+        if stats is not None:
+          values = dict(zip(ASL_FIXED_KEYS, values))
+        output(record_header, values, offset)
+    except (EnvironmentError, ValueError, zlib.error) as exception:
+      print '[Error]{}'.format(exception)
+      exit(1)
+    finish()
+    return
+
+  if os.path.isdir(log):
+    if options.index or options.last is not None:
+      parser.error('--index and --last are not available for a directory.')
+    paths = findStoreFiles(log)
+    kept = pruneStoreFiles(
+        log, paths, options.since, options.until, options.message_id)
+    if len(kept) < len(paths):
+      sys.stderr.write(
+          'Skipping {} files without the requested records.\n'.format(
+              len(paths) - len(kept)))
+      paths = kept
+    print '\nParsing the ASL store [{}], {} files.'.format(log, len(paths))
+    if options.search is not None:
+      for path in paths:
+        try:
+          data, header = openASLFile(path)
+        except (EnvironmentError, ValueError) as exception:
+          sys.stderr.write('[WARNING] Skipping {}: {}\n'.format(
+              path, exception))
+          continue
+        cache = None
+        if options.cache_size > 0:
+          cache = HeapStringCache(data, options.cache_size)
+        index_file = path + ASL_TEXT_EXTENSION
+        index = openTextIndex(index_file, data, header)
+        if index is None:
+          index = buildTextIndex(data, header, index_file, cache)
+        for offset, record_header, values in searchText(
+            data, header, index, options.search, cache, match):
+          if archive is None:
+            print '\t File: {}'.format(path)
+          output(record_header, values, offset)
+        data.close()
+      finish()
+      return
+    for path, offset, record_header, values in parseStore(
+        paths, options.processes, options.decoder, filters, project,
+        options.cache_size):
+      if stats is None and archive is None:
+        print '\t File: {}'.format(path)
+      output(record_header, values, offset)
+    finish()
+    return
+
+  if not os.path.isfile(log):
     print '[Error] The file ASL does not exist'
     exit(1)
 
+  if options.carve:
+    print '\nCarving ASL records from [{}].'.format(log)
+    try:
+      with open(log, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError) as exception:
+      print '[Error]{}'.format(exception)
+      exit(1)
+    for pos, base, record_header, values in carveRecords(data, match=match):
+      if base is None:
+        print '\t ASL file: unknown'
+      else:
+        print '\t ASL file in: {}'.format(hex(base))
+      if values is None or len(values) < len(ASL_FIXED_KEYS):
+        printRecordFields(record_header, pos)
+        print '\t * Values: not recoverable'
+        print '\t------------------------------------------------------'
+      else:
+        printRecord(record_header, values, pos)
+    data.close()
+    return
+
   print '\nParsing the ASL file [{}].'.format(log)
 
-  try: 
-    header = ASL_HEADER_STRUCT.parse_stream(f)
-  except:
-    print "[Error]It is not a ASL file, ASL Header not valid."
-    exit(1)
-  if header.magic != ASL_MAGIC:
-    print "[Error]It is not a ASL file, ASL_MAGIC invalid."
+  try:
+    data, header = openASLFile(log)
+  except (EnvironmentError, ValueError) as exception:
+    print '[Error]{}'.format(exception)
     exit(1)
-    
-  printHeader(header)
-  
-  offset = header.offset
-  last_offset = header.last_offset 
-  last = False
-
-  # Parsing the dynamic fields from the entry
-  while offset <= last_offset and last == False:
-    # The heap of the entry is saved to try to avoid seek (performance issue)
-    dynamic_start = f.tell()
-    dynamic_part = f.read(offset - f.tell())
-
-    record_header = ASL_RECORD_STRUCT.parse_stream(f)
-    
-    # -2 -> + 6 - 8
-    # +6 because the header already counts the padding + tam entry.
-    # -8 because the last 8 byte register is a pointer to the previous entry.
-    tam_entry = record_header.tam_entry - ASL_RECORD_STRUCT.sizeof() - 2
-
-    # Dynamic part of the entry
-    values = []
-    read_value = 0
-    while tam_entry > 0:
-      #print tam_entry
-      data = ASL_RECORD_ADDR_TXT.parse_stream(f)
-      tam_entry -= 8
-      # If not direction or data, jump to the next 8 bytes
-      # HELP: exists another option better than need to use the encode('hex')??
-      if data.addr_txt.encode('hex') != '0000000000000000':
-        # If it is direction then jump, if it is not, then read the data
-        if data.addr_txt.encode('hex')[0:1] != '8':
-          # If the pointer points to the dynamic header of the entry
-          pos = int(data.addr_txt.encode('hex'), 16) - dynamic_start
-          if pos >= 0:
-            values.append((ASL_RECORD_DYN_VALUE.parse(dynamic_part[pos:])).value)
-          else:
-            # Only if it is a pointer that points to the heap to another entry we use
-            # the seek method, avoiding performance issues
-            pos = f.tell()
-            f.seek(int(data.addr_txt.encode('hex'), 16))
-            values.append((ASL_RECORD_DYN_VALUE.parse_stream(f)).value)
-            # Come back to the position in the entry
-            f.seek(pos)
-        else:
-          values.append(data.addr_txt[1:])
 
-    # Print the record
-    printRecord(record_header, values, offset)
+  printHeader(header)
 
-    #Read the last 8 bytes that points to the previous position
-    f.read(8)
+  if options.numpy:
+    fields = recordFieldsArray(data, header, match)
+    numpy.save(options.numpy, fields)
+    print 'Saved {} records in {}.'.format(len(fields), options.numpy)
+    data.close()
+    return
 
-    # Last entry
-    if record_header.next_offset < offset:
-      last = True
+  cache = None
+  # The reference decoders always read the values from the file.
+  if options.cache_size > 0 and options.decoder == 'struct':
+    cache = HeapStringCache(data, options.cache_size)
+  reverse = False
+  if options.search is not None:
+    index_file = log + ASL_TEXT_EXTENSION
+    index = openTextIndex(index_file, data, header)
+    if index is None:
+      index = buildTextIndex(data, header, index_file, cache)
+    records = searchText(data, header, index, options.search, cache, match)
+  elif options.index:
+    index_file = options.index_file or log + ASL_INDEX_EXTENSION
+    index = openTimeIndex(index_file, data, header)
+    if index is None:
+      index = buildTimeIndex(data, header, index_file)
+    if options.message_id is not None:
+      entries = index.messageId(options.message_id)
     else:
-      # Jump to the next entry
-      offset = record_header.next_offset
+      entries = index.timeRange(options.since, options.until)
+    offsets = [offset for timestamp, offset in entries]
+    if options.last is not None:
+      offsets.reverse()
+    records = readRecordsAt(
+        data, header, offsets, options.decoder, cache, match, project)
+  # The tail of the file is read backwards, so it does not depend on its size.
+  elif options.last is not None or options.since is not None:
+    reverse = True
+    records = walkRecordsReverse(
+        data, header, options.decoder, cache, match, project)
+  else:
+    records = walkRecords(
+        data, header, options.decoder, cache, match=match, keys=project)
+  printed = 0
+  last = None
+  for offset, record_header, values in records:
+    last = offset
+    if (reverse and options.since is not None and
+        record_header.timestamp < options.since):
+      break
+    if values is None:
+      continue
+    output(record_header, values, offset)
+    printed += 1
+    if options.last is not None and printed >= options.last:
+      break
+
+  if options.follow:
+    # The reverse walk ends in the oldest record it read, the new records
+    # come after the newest one.
+    if reverse:
+      last = header.last_offset or None
+    sys.stdout.flush()
+    try:
+      for offset, record_header, values in followRecords(
+          log, last, options.decoder, cache, options.interval, match,
+          project):
+        if values is not None:
+          output(record_header, values, offset)
+          sys.stdout.flush()
+    except KeyboardInterrupt:
+      pass
+  finish()
+  if cache is not None:
+    sys.stderr.write('Heap string cache: {} hits, {} misses.\n'.format(
+        cache.hits, cache.misses))
+  data.close()
 
-__init__()
+if __name__ == '__main__':
+  __init__()
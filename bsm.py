@@ -32,13 +32,36 @@ __author__ = 'Joaquin Moreno Garijo (bastionado@gmail.com)'
 #       the structure. As an example, if the program tell you a [WARNING] providing an integer position
 #       of the structure, you only need to calculate the size as a integer + 50 and then "xxd -l size file"
 
+import argparse
+import array
+import binascii
+import bz2
+import calendar
+import collections
 import construct
+import cStringIO
 import datetime
+import itertools
+import logging
+import mmap
+import multiprocessing
 import os
+import re
 import socket
+import stat
 import struct
 import sys
 import time
+import zlib
+
+# The lzma module is only needed to read the trails compressed with xz.
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
 
 ##### CONSTANT #####
 
@@ -1089,6 +1112,9 @@ BSM_TOKEN_EXEC_ENV = BSM_TOKEN_EXEC_ARGUMENTS
 # au_to_zonename //AUT_ZONENAME
 BSM_TOKEN_ZONENAME = BSM_TOKEN_TEXT
 
+# Bytes checked by VerifyFile: the token ID and BSM_HEADER.
+BSM_VERIFY_SIZE = 1 + BSM_HEADER.sizeof()
+
 #### TOKEN ID ####
 # Only the checked structures are been added to the valid structures lists.
 BSM_TYPE_LIST = {
@@ -1202,7 +1228,7 @@ def FormatToken(token_id, token, f):
   elif (bsm_type == 'BSM_TOKEN_EXEC_ARGUMENTS' or
       bsm_type == 'BSM_TOKEN_EXEC_ENV'):
     arguments = []
-    for _ in range(token):
+    for _ in xrange(token):
       arguments.append(
           _RawToUTF8(BSM_TOKEN_EXEC_ARGUMENT.parse_stream(
               f)))
@@ -1220,7 +1246,7 @@ def FormatToken(token_id, token, f):
         bsm_type,
         BSM_PROTOCOLS.get(token.net_type, 'UNKNOWN'),
         token.net_type, token.port_number,
-        _Ipv6Format(token.ipv6.high, token.ipv6.low))
+        _IPv6Format(token.ipv6.high, token.ipv6.low))
   elif bsm_type == 'BSM_TOKEN_ADDR':
     return u'[{}: {}]'.format(bsm_type, _IPv4Format(token))
   elif bsm_type == 'BSM_TOKEN_IP':
@@ -1229,7 +1255,7 @@ def FormatToken(token_id, token, f):
     return u'[{0}: {1} ({2}). Address {3}]'.format(
         bsm_type,
         BSM_PROTOCOLS.get(token.net_type, 'UNKNOWN'),
-        token.net_type, _Ipv6Format(token.ipv6.high, token.ipv6.low))
+        token.net_type, _IPv6Format(token.ipv6.high, token.ipv6.low))
   elif bsm_type == 'BSM_TOKEN_PORT':
     return u'[{}: {}]'.format(bsm_type, token)
   elif bsm_type == 'BSM_TOKEN_TRAILER':
@@ -1288,20 +1314,22 @@ def FormatToken(token_id, token, f):
     if data_type == 'AUR_CHAR':
       for _ in range(token.unit_count):
         data.append(BSM_TOKEN_DATA_CHAR.parse_stream(f))
+      data = _RawToUTF8(''.join(data))
     elif data_type == 'AUR_SHORT':
       for _ in range(token.unit_count):
-        data.append(BSM_TOKEN_DAT_SHORT.parse_stream(f))
+        data.append(u'{}'.format(BSM_TOKEN_DATA_SHORT.parse_stream(f)))
+      data = u' '.join(data)
     elif data_type == 'AUR_INT32':
       for _ in range(token.unit_count):
-        data.append(BSM_TOKEN_DATA_INTEGER.parse_stream(f))
+        data.append(u'{}'.format(BSM_TOKEN_DATA_INTEGER.parse_stream(f)))
+      data = u' '.join(data)
     else:
-      data.append(u'Unknown type data')
+      data = u'Unknown type data'
     # TODO: the data when it is string ends with ".", HW a space is return
     #       after uses the UTF-8 conversion.
     return u'[{}: Format data: {}, Data: {}]'.format(
         bsm_type,
-        BSM_TOKEN_DATA_PRINT[token.how_to_print],
-        _RawToUTF8(u''.join(data)))
+        BSM_TOKEN_DATA_PRINT[token.how_to_print], data)
   elif (bsm_type == 'BSM_TOKEN_ATTR32' or
       bsm_type == 'BSM_TOKEN_ATTR64'):
     return (u'[{0}: Mode: {1}, UID: {2}, GID: {3}, '
@@ -1313,15 +1341,14 @@ def FormatToken(token_id, token, f):
     arguments = []
     for _ in range(token):
       arguments.append(
-          _RawToUTF8(BSM_TOKEN_DATA_INTEGER.parse_stream(
-              f)))
+          u'{}'.format(BSM_TOKEN_DATA_INTEGER.parse_stream(f)))
     return u'[{}: {}]'.format(bsm_type, u','.join(arguments))
   elif bsm_type == 'BSM_TOKEN_AUT_SOCKINET32_EX':
     if BSM_PROTOCOLS.get(token.socket_domain, '') == 'INET6':
-      sadd = _Ipv6Format(
+      sadd = _IPv6Format(
           token.structure_addr_port.saddr_high,
           token.structure_addr_port.saddr_low)
-      dadd = _Ipv6Format(
+      dadd = _IPv6Format(
           token.structure_addr_port.daddr_high,
           token.structure_addr_port.daddr_low)
       return u'[{}: from {} port {} to {} port {}]'.format(
@@ -1368,122 +1395,1731 @@ def _RawToUTF8(text):
     text = text.decode('utf-8', 'ignore')
   return text.partition('\x00')[0]
 
-# Read one BSM Event
+#### STRUCT DECODERS ####
+
+# Precompiled decoders, construct is only kept as reference implementation.
+# A decoder gets the record and the position after the token ID, and returns
+# (token, position after the token). The token is a tuple with the fields of
+# the construct structure in the same order, the IP addresses are kept as
+# the raw bytes in network order.
+
+# Token ID and length of the header, the first bytes of every record.
+BSM_RECORD_START = struct.Struct('>BI')
+
+# Minimum size of the record for each header token ID (IPv4 for 116).
+BSM_HEADER_SIZE = {20: 18, 21: 26, 116: 26}
+
+BSM_HEADER32_STRUCT = struct.Struct('>IBHHII')
+BSM_HEADER64_STRUCT = struct.Struct('>IBHHQQ')
+BSM_HEADER32_EX_STRUCT = struct.Struct('>IBHHI')
+BSM_TIMESTAMP32_STRUCT = struct.Struct('>II')
+BSM_DATA_STRUCT = struct.Struct('>BBB')
+BSM_SHORT = struct.Struct('>H')
+BSM_INTEGER = struct.Struct('>I')
+
+# au_to_socket_ex, the address part depends on the socket domain.
+BSM_SOCKET_DOMAIN_INET6 = 26
+BSM_SOCKET_DOMAIN = struct.Struct('>HH')
+BSM_SOCKET_INET = struct.Struct('>HH4sH4s')
+BSM_SOCKET_INET6 = struct.Struct('>HH16sH16s')
+
+# Header token: the fields of BSM_HEADER plus the timestamp, address is the
+# IP of BSM_HEADER32_EX (None in the other headers).
+BSMHeader = collections.namedtuple('BSMHeader', [
+    'length', 'version', 'event_type', 'modifier', 'timestamp',
+    'microsecond', 'address'])
+
+# Result of decoding a record.
+#  header: BSMHeader.
+#  tokens: list of formatted tokens.
+#  status: one of the BSM_RECORD_* values.
+#  position: where the decoding stopped, relative to the record.
+BSMEvent = collections.namedtuple('BSMEvent', [
+    'header', 'tokens', 'status', 'position'])
+
+# All the tokens were read.
+BSM_RECORD_COMPLETE = 0
+# Unknown token ID at position, the rest of the record is skipped.
+BSM_RECORD_UNFINISHED = 1
+# The token at position goes beyond the end of the record.
+BSM_RECORD_OVERRUN = 2
+# The file ends before the end of the record.
+BSM_RECORD_TRUNCATED = 3
+
+# Available decoders for the records.
+BSM_DECODERS = ['struct', 'construct', 'verify']
+
+BSM_SUBJECT_FORMAT = (
+    u'[{}: aid({}), euid({}), egid({}), uid({}), gid({}), pid({}), '
+    u'session_id({}), terminal_port({}), terminal_ip({})]')
+
+# Decoder of a token with a fixed size.
+def _FixedDecoder(layout):
+  structure = struct.Struct(layout)
+  unpack_from = structure.unpack_from
+  size = structure.size
+  def Decode(data, pos):
+    return unpack_from(data, pos), pos + size
+  return Decode
+
+# Decoder of a token with a fixed part followed by a BSM_TOKEN_TEXT.
+def _TextDecoder(layout):
+  structure = struct.Struct(layout + 'H')
+  unpack_from = structure.unpack_from
+  size = structure.size
+  def Decode(data, pos):
+    token = unpack_from(data, pos)
+    pos += size
+    end = pos + token[-1]
+    return token[:-1] + (data[pos:end],), end
+  return Decode
+
+# Decoder of a token with a fixed part that ends with the net_type of a
+# BSM_IP_TYPE_SHORT, followed by its IPv4 or IPv6 address.
+def _AddressDecoder(layout):
+  structure = struct.Struct(layout + 'I')
+  unpack_from = structure.unpack_from
+  size = structure.size
+  def Decode(data, pos):
+    token = unpack_from(data, pos)
+    pos += size
+    if token[-1] == AU_IPv6:
+      end = pos + 16
+    else:
+      end = pos + 4
+    return token + (data[pos:end],), end
+  return Decode
+
+def _DecodeHeader32(data, pos):
+  token = BSM_HEADER32_STRUCT.unpack_from(data, pos)
+  return BSMHeader._make(token + (None,)), pos + BSM_HEADER32_STRUCT.size
+
+def _DecodeHeader64(data, pos):
+  token = BSM_HEADER64_STRUCT.unpack_from(data, pos)
+  return BSMHeader._make(token + (None,)), pos + BSM_HEADER64_STRUCT.size
+
+def _DecodeHeader32Ex(data, pos):
+  token = BSM_HEADER32_EX_STRUCT.unpack_from(data, pos)
+  pos += BSM_HEADER32_EX_STRUCT.size
+  if token[-1] == AU_IPv6:
+    end = pos + 16
+  else:
+    end = pos + 4
+  timestamp = BSM_TIMESTAMP32_STRUCT.unpack_from(data, end)
+  return (BSMHeader._make(token[:-1] + timestamp + (data[pos:end],)),
+          end + BSM_TIMESTAMP32_STRUCT.size)
+
+# BSM_TOKEN_DATA: (how_to_print, data_type, unit_count, data), data is a
+# string for AUR_CHAR, a tuple of integers for the other types or None if
+# the type is unknown.
+def _DecodeData(data, pos):
+  how_to_print, data_type, unit_count = BSM_DATA_STRUCT.unpack_from(data, pos)
+  pos += BSM_DATA_STRUCT.size
+  if data_type == 0:
+    values = data[pos:pos + unit_count]
+    pos += unit_count
+  elif data_type == 1:
+    values = struct.unpack_from('>{}H'.format(unit_count), data, pos)
+    pos += 2 * unit_count
+  elif data_type == 2:
+    values = struct.unpack_from('>{}I'.format(unit_count), data, pos)
+    pos += 4 * unit_count
+  else:
+    values = None
+  return (how_to_print, data_type, unit_count, values), pos
+
+# BSM_TOKEN_GROUPS: a tuple with the groups.
+def _DecodeGroups(data, pos):
+  group_number, = BSM_SHORT.unpack_from(data, pos)
+  pos += BSM_SHORT.size
+  groups = struct.unpack_from('>{}I'.format(group_number), data, pos)
+  return groups, pos + 4 * group_number
+
+# BSM_TOKEN_EXEC_ARGUMENTS: a tuple with the arguments.
+def _DecodeExecArguments(data, pos):
+  number_arguments, = BSM_INTEGER.unpack_from(data, pos)
+  pos += BSM_INTEGER.size
+  arguments = []
+  for _ in xrange(number_arguments):
+    end = data.find('\x00', pos)
+    if end < 0:
+      # Beyond the end of the record, the caller reports it.
+      return tuple(arguments), len(data) + 1
+    arguments.append(data[pos:end])
+    pos = end + 1
+  return tuple(arguments), pos
+
+# BSM_TOKEN_AUT_SOCKINET32_EX: (socket_domain, socket_type, ip_type,
+# source_port, source_address, destination_port, destination_address).
+def _DecodeSocketEx(data, pos):
+  socket_domain, socket_type = BSM_SOCKET_DOMAIN.unpack_from(data, pos)
+  pos += BSM_SOCKET_DOMAIN.size
+  if socket_domain == BSM_SOCKET_DOMAIN_INET6:
+    structure = BSM_SOCKET_INET6
+  else:
+    structure = BSM_SOCKET_INET
+  token = (socket_domain, socket_type) + structure.unpack_from(data, pos)
+  return token, pos + structure.size
+
+# IPv4 or IPv6 address in network order to text.
+def _AddressToText(address):
+  if len(address) == 16:
+    return socket.inet_ntop(socket.AF_INET6, address)
+  return socket.inet_ntoa(address)
+
+# Address of a BSM_IP_TYPE_SHORT to text.
+def _IPTypeToText(net_type, address):
+  if net_type == AU_IPv6 or net_type == AU_IPv4:
+    return _AddressToText(address)
+  return 'unknown'
+
+# Formatters of the decoded tokens, they return the same text as FormatToken.
+#
 # Args:
-#   f : BSM file.
-#   token_id: header token_id.
-#   event_number: the number of the event.
-def ReadBSMEvent(f, token_id, event_number):
-  first_byte = f.tell() - 1
-  bsm_type, structure = BSM_TYPE_LIST.get(token_id, ['', ''])
-  if bsm_type == 'BSM_HEADER32':
-      token = structure.parse_stream(f)
-  elif bsm_type == 'BSM_HEADER64':
-    token = structure.parse_stream(f)
-  elif bsm_type == 'BSM_HEADER32_EX':
-    token = structure.parse_stream(f)
+#   bsm_type: text name of the token.
+#   token: the tuple returned by the decoder.
+
+# FormatToken does not format headers found inside a record.
+def _FormatHeader(bsm_type, token):
+  return None
+
+def _FormatText(bsm_type, token):
+  return u'[{}: {}]'.format(bsm_type, _RawToUTF8(token[0]))
+
+def _FormatValue(bsm_type, token):
+  return u'[{}: {}]'.format(bsm_type, token[0])
+
+def _FormatOpaque(bsm_type, token):
+  return u'[{}: {}]'.format(bsm_type, token[0].encode('hex'))
+
+def _FormatReturn(bsm_type, token):
+  return u'[{}: {} ({}), System call status: {}]'.format(
+      bsm_type, BSM_ERRORS.get(token[0], 'Unknown'), token[0], token[1])
+
+def _FormatSubject(bsm_type, token):
+  return BSM_SUBJECT_FORMAT.format(
+      bsm_type, *(token[:8] + (socket.inet_ntoa(token[8]),)))
+
+def _FormatSubjectEx(bsm_type, token):
+  return BSM_SUBJECT_FORMAT.format(
+      bsm_type, *(token[:8] + (_IPTypeToText(token[-2], token[-1]),)))
+
+def _FormatArgument(bsm_type, token):
+  return u'[{}: {}({}) is 0x{:X}]'.format(
+      bsm_type, _RawToUTF8(token[2]), token[0], token[1])
+
+def _FormatExecArguments(bsm_type, token):
+  return u'[{}: {}]'.format(
+      bsm_type, u' '.join([_RawToUTF8(argument) for argument in token]))
+
+def _FormatSocket(bsm_type, token):
+  return u'[{0}: {1} ({2}) open in port {3}. Address {4}]'.format(
+      bsm_type, BSM_PROTOCOLS.get(token[0], 'UNKNOWN'), token[0], token[1],
+      _AddressToText(token[2]))
+
+def _FormatSocketEx(bsm_type, token):
+  return u'[{}: from {} port {} to {} port {}]'.format(
+      bsm_type, _AddressToText(token[4]), token[3],
+      _AddressToText(token[6]), token[5])
+
+def _FormatAddress(bsm_type, token):
+  return u'[{}: {}]'.format(bsm_type, socket.inet_ntoa(token[0]))
+
+def _FormatIP(bsm_type, token):
+  return u'[IPv4_Header: 0x{}]'.format(token[0].encode('hex'))
+
+def _FormatAddressEx(bsm_type, token):
+  return u'[{0}: {1} ({2}). Address {3}]'.format(
+      bsm_type, BSM_PROTOCOLS.get(token[0], 'UNKNOWN'), token[0],
+      _AddressToText(token[1]))
+
+def _FormatTrailer(bsm_type, token):
+  return u'[{}: {}]'.format(bsm_type, token[1])
+
+def _FormatFile(bsm_type, token):
+  human_timestamp = datetime.datetime.fromtimestamp(
+      token[0]).strftime('%Y-%m-%d %H:%M:%S')
+  return u'[{0}: {1}, timestamp: {2}]'.format(
+      bsm_type, _RawToUTF8(token[2]), human_timestamp)
+
+def _FormatIPC(bsm_type, token):
+  return u'[{}: object type {}, object id {}]'.format(
+      bsm_type, token[0], token[1])
+
+def _FormatData(bsm_type, token):
+  how_to_print, data_type, _, values = token
+  data_type = BSM_TOKEN_DATA_TYPE.get(data_type, '')
+  if data_type == 'AUR_CHAR':
+    data = _RawToUTF8(values)
+  elif values is not None:
+    data = u' '.join([u'{}'.format(value) for value in values])
   else:
-    print "[Error] At 0x{:X} header unknown.".format(f.tell())
+    data = u'Unknown type data'
+  return u'[{}: Format data: {}, Data: {}]'.format(
+      bsm_type, BSM_TOKEN_DATA_PRINT[how_to_print], data)
+
+def _FormatAttributes(bsm_type, token):
+  return (u'[{0}: Mode: {1}, UID: {2}, GID: {3}, '
+          u'File system ID: {4}, Node ID: {5}, Device: {6}]'.format(
+              bsm_type, *token))
+
+def _FormatGroups(bsm_type, token):
+  return u'[{}: {}]'.format(
+      bsm_type, u','.join([u'{}'.format(group) for group in token]))
+
+# Same tokens as BSM_TYPE_LIST: {token_id: [name, decoder, formatter]}.
+BSM_TOKEN_DECODERS = {
+    17: ['BSM_TOKEN_FILE', _TextDecoder('>II'), _FormatFile],
+    19: ['BSM_TOKEN_TRAILER', _FixedDecoder('>HI'), _FormatTrailer],
+    20: ['BSM_HEADER32', _DecodeHeader32, _FormatHeader],
+    21: ['BSM_HEADER64', _DecodeHeader64, _FormatHeader],
+    33: ['BSM_TOKEN_DATA', _DecodeData, _FormatData],
+    34: ['BSM_TOKEN_IPC', _FixedDecoder('>BI'), _FormatIPC],
+    35: ['BSM_TOKEN_PATH', _TextDecoder('>'), _FormatText],
+    36: ['BSM_TOKEN_SUBJECT32', _FixedDecoder('>8I4s'), _FormatSubject],
+    38: ['BSM_TOKEN_PROCESS32', _FixedDecoder('>8I4s'), _FormatSubject],
+    39: ['BSM_TOKEN_RETURN32', _FixedDecoder('>BI'), _FormatReturn],
+    40: ['BSM_TOKEN_TEXT', _TextDecoder('>'), _FormatText],
+    41: ['BSM_TOKEN_OPAQUE', _TextDecoder('>'), _FormatOpaque],
+    42: ['BSM_TOKEN_ADDR', _FixedDecoder('>4s'), _FormatAddress],
+    43: ['BSM_TOKEN_IP', _FixedDecoder('>20s'), _FormatIP],
+    44: ['BSM_TOKEN_PORT', _FixedDecoder('>H'), _FormatValue],
+    45: ['BSM_TOKEN_ARGUMENT32', _TextDecoder('>BI'), _FormatArgument],
+    47: ['BSM_TOKEN_SEQUENCE', _FixedDecoder('>I'), _FormatValue],
+    49: ['BSM_TOKEN_ATTR32', _FixedDecoder('>IIIIQI'), _FormatAttributes],
+    52: ['BSM_TOKEN_GROUPS', _DecodeGroups, _FormatGroups],
+    59: ['BSM_TOKEN_GROUPS', _DecodeGroups, _FormatGroups],
+    60: ['BSM_TOKEN_EXEC_ARGUMENTS', _DecodeExecArguments,
+         _FormatExecArguments],
+    61: ['BSM_TOKEN_EXEC_ENV', _DecodeExecArguments, _FormatExecArguments],
+    62: ['BSM_TOKEN_ATTR32', _FixedDecoder('>IIIIQI'), _FormatAttributes],
+    82: ['BSM_TOKEN_EXIT', _FixedDecoder('>II'), _FormatReturn],
+    96: ['BSM_TOKEN_ZONENAME', _TextDecoder('>'), _FormatText],
+    113: ['BSM_TOKEN_ARGUMENT64', _TextDecoder('>BQ'), _FormatArgument],
+    114: ['BSM_TOKEN_RETURN64', _FixedDecoder('>BQ'), _FormatReturn],
+    115: ['BSM_TOKEN_ATTR64', _FixedDecoder('>IIIIQQ'), _FormatAttributes],
+    116: ['BSM_HEADER32_EX', _DecodeHeader32Ex, _FormatHeader],
+    117: ['BSM_TOKEN_SUBJECT64', _FixedDecoder('>7IQ4s'), _FormatSubject],
+    119: ['BSM_TOKEN_PROCESS64', _FixedDecoder('>7IQ4s'), _FormatSubject],
+    122: ['BSM_TOKEN_SUBJECT32_EX', _AddressDecoder('>8I'), _FormatSubjectEx],
+    123: ['BSM_TOKEN_PROCESS32_EX', _AddressDecoder('>8I'), _FormatSubjectEx],
+    124: ['BSM_TOKEN_PROCESS64_EX', _AddressDecoder('>7IQ'),
+          _FormatSubjectEx],
+    125: ['BSM_TOKEN_SUBJECT64_EX', _AddressDecoder('>9I'), _FormatSubjectEx],
+    126: ['BSM_TOKEN_ADDR_EXT', _FixedDecoder('>I16s'), _FormatAddressEx],
+    127: ['BSM_TOKEN_AUT_SOCKINET32_EX', _DecodeSocketEx, _FormatSocketEx],
+    128: ['BSM_TOKEN_AUT_SOCKINET32', _FixedDecoder('>HH4s'), _FormatSocket],
+    129: ['BSM_TOKEN_AUT_SOCKINET128', _FixedDecoder('>HH16s'),
+          _FormatSocket]}
+
+# Read one BSM record.
+#
+# Args:
+#   f: BSM file, at the beginning of a record.
+#
+# Returns:
+#   The bytes of the record, from the header token ID up to the end of the
+#   trailer, or None at the end of the file. It can be shorter than the
+#   length of the header if the file is truncated.
+def ReadBSMRecord(f):
+  start = f.read(BSM_RECORD_START.size)
+  # A zero token ID is padding at the end of the file.
+  if not start or start[0] == '\x00':
+    return None
+  token_id = ord(start[0])
+  if (token_id not in BSM_HEADER_SIZE or
+      len(start) < BSM_RECORD_START.size):
+    print "[Error] At 0x{:X} header unknown.".format(
+        f.tell() - len(start) + 1)
     exit(1)
+  _, length = BSM_RECORD_START.unpack(start)
+  size = max(length, BSM_HEADER_SIZE[token_id])
+  return start + f.read(size - BSM_RECORD_START.size)
 
-  data = []
-  length = token.bsm_header.length
-  next_entry = first_byte + length
-  event_type = u'{0} ({1})'.format(
-      BSM_AUDIT_EVENT.get(token.bsm_header.event_type, 'UNKNOWN'),
-      token.bsm_header.event_type)
-  human_timestamp = datetime.datetime.fromtimestamp(
-        token.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+# Decode only the header of a BSM record.
+#
+# Args:
+#   record: the record, as returned by ReadBSMRecord.
+#
+# Returns:
+#   The BSMHeader.
+def DecodeBSMHeader(record):
+  header, _ = BSM_TOKEN_DECODERS[ord(record[0])][1](record, 1)
+  return header
 
-  # Read until we reach the end of the record.
-  while f.tell() < (first_byte + length):
-    # Check if it is a known token.
+# Decode a BSM record with the struct decoders.
+#
+# Args:
+#   record: the record, as returned by ReadBSMRecord.
+#
+# Returns:
+#   A BSMEvent.
+def DecodeBSMRecord(record):
+  _, decoder, _ = BSM_TOKEN_DECODERS[ord(record[0])]
+  header, pos = decoder(record, 1)
+  length = header.length
+  end = min(length, len(record))
+  tokens = []
+  while pos < length:
+    if pos >= end:
+      return BSMEvent(header, tokens, BSM_RECORD_TRUNCATED, pos)
+    entry = BSM_TOKEN_DECODERS.get(ord(record[pos]), None)
+    if entry is None:
+      return BSMEvent(header, tokens, BSM_RECORD_UNFINISHED, pos)
+    bsm_type, decoder, formatter = entry
+    try:
+      token, next_pos = decoder(record, pos + 1)
+    except struct.error:
+      next_pos = end + 1
+    if next_pos > end:
+      return BSMEvent(header, tokens, BSM_RECORD_OVERRUN, pos)
+    tokens.append(formatter(bsm_type, token))
+    pos = next_pos
+  return BSMEvent(header, tokens, BSM_RECORD_COMPLETE, pos)
+
+# Reference decoder of a BSM record using construct and FormatToken.
+def DecodeBSMRecordConstruct(record):
+  f = cStringIO.StringIO(record)
+  bsm_type, structure = BSM_TYPE_LIST[BSM_TYPE.parse_stream(f)]
+  token = structure.parse_stream(f)
+  address = None
+  if bsm_type == 'BSM_HEADER32_EX':
+    if token.bsm_ip_type_short.net_type == AU_IPv6:
+      address = IPV6_STRUCT.build(token.bsm_ip_type_short.ip_addr)
+    else:
+      address = IPV4_STRUCT.build(token.bsm_ip_type_short.ip_addr)
+  header = BSMHeader(
+      token.bsm_header.length, token.bsm_header.version,
+      token.bsm_header.event_type, token.bsm_header.modifier,
+      token.timestamp, token.microsecond, address)
+  tokens = []
+  while f.tell() < header.length:
+    pos = f.tell()
     try:
       token_id = BSM_TYPE.parse_stream(f)
     except (IOError, construct.FieldError):
-      print (
-          u'Unable to parse the Token ID at '
-          u'position "{}"'.format(f.tell()))
-      return
-    # Unknown token id
+      return BSMEvent(header, tokens, BSM_RECORD_TRUNCATED, pos)
     if not token_id in BSM_TYPE_LIST:
-      f.seek(next_entry - f.tell(), os.SEEK_CUR)
-      print '\t[Unfinished] Event: {}.\n\tType: {}.\n\tTimestamp: {}.'.format(
-          event_number, event_type, human_timestamp)
-      for i in range(len(data)):
-        print u'\t{}'.format(data[i])
-      print ''
+      return BSMEvent(header, tokens, BSM_RECORD_UNFINISHED, pos)
+    try:
+      token = BSM_TYPE_LIST[token_id][1].parse_stream(f)
+      tokens.append(FormatToken(token_id, token, f))
+    except construct.ConstructError:
+      return BSMEvent(header, tokens, BSM_RECORD_OVERRUN, pos)
+  return BSMEvent(header, tokens, BSM_RECORD_COMPLETE, f.tell())
+
+# Decode a record with both decoders and check that they agree.
+#
+# Args:
+#   record: the record, as returned by ReadBSMRecord.
+#   offset: position of the record in the file.
+#
+# Returns:
+#   The BSMEvent decoded by construct, or exits if the decoders disagree.
+def DecodeBSMRecordVerify(record, offset):
+  event = DecodeBSMRecordConstruct(record)
+  fast_event = DecodeBSMRecord(record)
+  for field in BSMEvent._fields:
+    if getattr(event, field) != getattr(fast_event, field):
+      print '[Error] Decoders disagree in the {} of the record 0x{:X}.'.format(
+          field, offset)
+      exit(1)
+  return event
+
+# Decode a record with one of BSM_DECODERS.
+#
+# Args:
+#   record: the record, as returned by ReadBSMRecord.
+#   offset: position of the record in the file.
+#   decoder: one of BSM_DECODERS.
+#
+# Returns:
+#   A BSMEvent.
+def DecodeBSMEvent(record, offset, decoder='struct'):
+  if decoder == 'construct':
+    return DecodeBSMRecordConstruct(record)
+  elif decoder == 'verify':
+    return DecodeBSMRecordVerify(record, offset)
+  return DecodeBSMRecord(record)
+
+# Text of one BSM Event, without its number.
+#
+# The number of an event is only known once all the previous records were
+# read, so it is not part of the text.
+#
+# Args:
+#   event: the BSMEvent.
+#   offset: position of the record in the file.
+#
+# Returns:
+#   (title, text): the event is printed as the title, its number and the
+#   text. If title is None the text is printed alone, and if both are None
+#   nothing is printed (the problem is logged as a warning).
+def FormatBSMEvent(event, offset):
+  if event.status == BSM_RECORD_TRUNCATED:
+    return None, (
+        u'Unable to parse the Token ID at '
+        u'position "{}"'.format(offset + event.position))
+  if event.status == BSM_RECORD_OVERRUN:
+    logging.warning(
+        u'Token not expected at position 0x{0:X}.'
+        u'Jumping to the next entry'.format(offset + event.position))
+    return None, None
+  event_type = u'{0} ({1})'.format(
+      BSM_AUDIT_EVENT.get(event.header.event_type, 'UNKNOWN'),
+      event.header.event_type)
+  human_timestamp = datetime.datetime.fromtimestamp(
+        event.header.timestamp).strftime('%Y-%m-%d %H:%M:%S')
+  if event.status == BSM_RECORD_UNFINISHED:
+    title = '\t[Unfinished] Event: '
+  else:
+    title = '\tEvent: '
+  lines = ['.\n\tType: {}.\n\tTimestamp: {}.'.format(
+      event_type, human_timestamp)]
+  for token in event.tokens:
+    lines.append(u'\t{}'.format(token))
+  lines.append('')
+  return title, u'\n'.join(lines)
+
+# Print the text of one BSM Event.
+#
+# Args:
+#   formatted: (title, text) as returned by FormatBSMEvent.
+#   event_number: the number of the event.
+def PrintBSMText(formatted, event_number):
+  title, text = formatted
+  if title is not None:
+    print u'{}{}{}'.format(title, event_number, text)
+  elif text is not None:
+    print text
+
+# Print one BSM Event
+#
+# Args:
+#   event: the BSMEvent.
+#   event_number: the number of the event.
+#   offset: position of the record in the file.
+def PrintBSMEvent(event, event_number, offset):
+  PrintBSMText(FormatBSMEvent(event, offset), event_number)
+
+#### STREAMS ####
+
+# Size of the reads of BSMStream.
+BSM_READ_SIZE = 64 * 1024
+
+# Bigger records are considered corrupted.
+BSM_MAX_RECORD_SIZE = 1024 * 1024
+
+# Reader of the records of a BSM stream.
+#
+# It never seeks, so the records can come from a pipe, the standard input
+# or a decompressor. The records are framed with the length of their header
+# in a buffer that holds at most one read plus one record.
+class BSMStream(object):
+
+  # Args:
+  #   f: file object, only its read method is used.
+  #   max_record_size: bigger records stop the parsing.
+  #   read_size: bytes requested in each read.
+  def __init__(self, f, max_record_size=BSM_MAX_RECORD_SIZE,
+               read_size=BSM_READ_SIZE):
+    self._read = f.read
+    # The read of a file object waits until it has all the bytes, on a pipe
+    # the records that are already available are parsed.
+    try:
+      fileno = f.fileno()
+      if not stat.S_ISREG(os.fstat(fileno).st_mode):
+        self._read = lambda size: os.read(fileno, size)
+    except (AttributeError, EnvironmentError, ValueError):
+      pass
+    self._buffer = ''
+    self._pos = 0
+    self._eof = False
+    self.max_record_size = max_record_size
+    self.read_size = read_size
+    # Position in the stream of the next record.
+    self.offset = 0
+
+  # Buffer the next size bytes, or the rest of the stream if it is shorter.
+  def _Fill(self, size):
+    available = len(self._buffer) - self._pos
+    if available >= size or self._eof:
       return
+    chunks = [self._buffer[self._pos:]]
+    while available < size:
+      data = self._read(max(self.read_size, size - available))
+      if not data:
+        self._eof = True
+        break
+      chunks.append(data)
+      available += len(data)
+    self._buffer = ''.join(chunks)
+    self._pos = 0
+
+  # Read at most size bytes, as the read of a file object, so another reader
+  # can be chained to the stream after its first bytes were peeked.
+  def read(self, size):
+    if self._pos < len(self._buffer):
+      data = self._buffer[self._pos:self._pos + size]
+      self._pos += len(data)
+    elif self._eof:
+      data = ''
     else:
-      token = BSM_TYPE_LIST[token_id][1].parse_stream(f)
-      data.append(FormatToken(token_id, token, f))
-
-    if f.tell() > next_entry:
-      logging.warning(
-          u'Token ID {0} not expected at position 0x{1:X}.'
-          u'Jumping to the next entry'.format(
-              token_id, f.tell()))
-      f.seek(next_entry - f.tell(), os.SEEK_CUR)
+      data = self._read(size)
+    self.offset += len(data)
+    return data
+
+  # Skip the next size bytes.
+  def Skip(self, size):
+    while size > 0 and self.Peek(1):
+      skipped = min(size, len(self._buffer) - self._pos)
+      self._pos += skipped
+      self.offset += skipped
+      size -= skipped
+
+  # The next size bytes, without consuming them.
+  def Peek(self, size):
+    self._Fill(size)
+    return self._buffer[self._pos:self._pos + size]
+
+  # Read the next record, as ReadBSMRecord.
+  def ReadRecord(self):
+    start = self.Peek(BSM_RECORD_START.size)
+    # A zero token ID is padding at the end of the file.
+    if not start or start[0] == '\x00':
+      return None
+    token_id = ord(start[0])
+    if (token_id not in BSM_HEADER_SIZE or
+        len(start) < BSM_RECORD_START.size):
+      print "[Error] At 0x{:X} header unknown.".format(self.offset + 1)
+      exit(1)
+    _, length = BSM_RECORD_START.unpack(start)
+    size = max(length, BSM_HEADER_SIZE[token_id])
+    if size > self.max_record_size:
+      print '[Error] At 0x{:X} record of {} bytes, the maximum is {}.'.format(
+          self.offset + 1, size, self.max_record_size)
+      exit(1)
+    self._Fill(size)
+    record = self._buffer[self._pos:self._pos + size]
+    self._pos += len(record)
+    self.offset += len(record)
+    return record
+
+#### LAZY RECORDS ####
+
+# BSM record whose tokens are only decoded when they are requested.
+#
+# The header is decoded when the record is created, so filtering or counting
+# on its fields costs one unpack. The other tokens stay as the raw bytes of
+# the record; the first time one of them is requested, a table with the
+# position of every token is built by walking their sizes, and then only the
+# requested tokens are decoded.
+class BSMRecord(object):
+
+  __slots__ = BSMHeader._fields + (
+      'offset', 'token_id', 'raw', '_start', '_positions', '_status',
+      '_position')
+
+  # Args:
+  #   offset: position of the record in the file.
+  #   record: the record, as returned by ReadBSMRecord.
+  def __init__(self, offset, record):
+    self.offset = offset
+    self.token_id = ord(record[0])
+    self.raw = record
+    header, self._start = BSM_TOKEN_DECODERS[self.token_id][1](record, 1)
+    (self.length, self.version, self.event_type, self.modifier,
+     self.timestamp, self.microsecond, self.address) = header
+    self._positions = None
+    self._status = None
+    self._position = None
+
+  # Build the table with the position of each token after the header.
+  def _Walk(self):
+    record = self.raw
+    length = self.length
+    end = min(length, len(record))
+    positions = array.array('L')
+    status = BSM_RECORD_COMPLETE
+    pos = self._start
+    while pos < length:
+      if pos >= end:
+        status = BSM_RECORD_TRUNCATED
+        break
+      entry = BSM_TOKEN_DECODERS.get(ord(record[pos]), None)
+      if entry is None:
+        status = BSM_RECORD_UNFINISHED
+        break
+      try:
+        _, next_pos = entry[1](record, pos + 1)
+      except struct.error:
+        next_pos = end + 1
+      if next_pos > end:
+        status = BSM_RECORD_OVERRUN
+        break
+      positions.append(pos)
+      pos = next_pos
+    self._positions = positions
+    self._status = status
+    self._position = pos
+
+  def _Positions(self):
+    if self._positions is None:
+      self._Walk()
+    return self._positions
+
+  # One of the BSM_RECORD_* values, as in BSMEvent.
+  @property
+  def status(self):
+    self._Positions()
+    return self._status
+
+  # Where the walk of the tokens stopped, relative to the record.
+  @property
+  def position(self):
+    self._Positions()
+    return self._position
+
+  # Number of tokens after the header that can be decoded.
+  def __len__(self):
+    return len(self._Positions())
+
+  # Token ID of a token, the first token after the header is 0.
+  def TokenId(self, number):
+    return ord(self.raw[self._Positions()[number]])
+
+  # Decode a token.
+  #
+  # Returns:
+  #   (name, token): the name of the token and the tuple of its decoder.
+  def Token(self, number):
+    pos = self._Positions()[number]
+    bsm_type, decoder, _ = BSM_TOKEN_DECODERS[ord(self.raw[pos])]
+    token, _ = decoder(self.raw, pos + 1)
+    return bsm_type, token
+
+  # Text of a token, as FormatToken.
+  def Text(self, number):
+    pos = self._Positions()[number]
+    bsm_type, decoder, formatter = BSM_TOKEN_DECODERS[ord(self.raw[pos])]
+    token, _ = decoder(self.raw, pos + 1)
+    return formatter(bsm_type, token)
+
+  # Numbers of the tokens with a token ID.
+  def Find(self, token_id):
+    record = self.raw
+    return [number for number, pos in enumerate(self._Positions())
+            if ord(record[pos]) == token_id]
+
+  # Text of all the tokens after the header.
+  @property
+  def tokens(self):
+    return [self.Text(number) for number in xrange(len(self))]
+
+  # Decode the whole record.
+  #
+  # Args:
+  #   decoder: one of BSM_DECODERS.
+  #
+  # Returns:
+  #   A BSMEvent.
+  def Event(self, decoder='struct'):
+    return DecodeBSMEvent(self.raw, self.offset, decoder)
+
+# Read the records of a BSM file or stream.
+#
+# Args:
+#   f: BSM file at the beginning of a record, or a BSMStream.
+#   offset: position of f in the file.
+#   match: optional predicate over a BSMRecord, it is evaluated before any
+#          token after the header is read.
+#
+# Yields:
+#   A BSMRecord for each record that matches.
+def ReadBSMRecords(f, offset=0, match=None):
+  if not isinstance(f, BSMStream):
+    f = BSMStream(f)
+  record = f.ReadRecord()
+  while record:
+    bsm_record = BSMRecord(offset, record)
+    if not match or match(bsm_record):
+      yield bsm_record
+    offset += len(record)
+    record = f.ReadRecord()
+
+#### RECORD INDEX ####
+
+# Sidecar record index: [Index_Header][Record_Entry]*[Time_Entry]*
+# The size and modification time of the BSM file are saved to know if the
+# index is still valid. Record entries are in the order of the file, time
+# entries are the number of the record entries sorted by (timestamp, number).
+BSM_INDEX_MAGIC = 'BSMIDX\x00\x01'
+BSM_INDEX_HEADER = struct.Struct('>8sQdQ')
+BSM_INDEX_ENTRY = struct.Struct('>QIHBQ')
+BSM_INDEX_TIME = struct.Struct('>QQ')
+BSM_INDEX_EXTENSION = '.idx'
+
+# Record entry of the index, token_id is the header variant.
+BSMIndexEntry = collections.namedtuple('BSMIndexEntry', [
+    'offset', 'length', 'event_type', 'token_id', 'timestamp'])
+
+# Walk the records of a BSM file reading only their headers.
+#
+# The length of the header is used to jump to the next record, the other
+# tokens are never read.
+#
+# Args:
+#   data: the memory mapped BSM file.
+#
+# Yields:
+#   (offset, token_id, header): where the record starts, the token ID of its
+#   header and the BSMHeader.
+def ScanBSMHeaders(data):
+  offset = 0
+  size = len(data)
+  while offset < size:
+    token_id = ord(data[offset])
+    # A zero token ID is padding at the end of the file.
+    if not token_id:
+      break
+    if (token_id not in BSM_HEADER_SIZE or
+        offset + BSM_HEADER_SIZE[token_id] > size):
+      print "[Error] At 0x{:X} header unknown.".format(offset + 1)
+      exit(1)
+    header, _ = BSM_TOKEN_DECODERS[token_id][1](data, offset + 1)
+    yield offset, token_id, header
+    offset += max(header.length, BSM_HEADER_SIZE[token_id])
+
+# Record index of a BSM file saved next to it.
+#
+# As the ASL time index, it is read from the mapped index with binary
+# searches, the index is never loaded in memory.
+class BSMIndex(object):
+
+  def __init__(self, data):
+    self.data = data
+    _, self.file_size, self.mtime, self.count = (
+        BSM_INDEX_HEADER.unpack_from(data, 0))
+    self.record_table = BSM_INDEX_HEADER.size
+    self.time_table = self.record_table + self.count * BSM_INDEX_ENTRY.size
+
+  # Record entry by its number, the first record is 0.
+  def Entry(self, number):
+    return BSMIndexEntry._make(BSM_INDEX_ENTRY.unpack_from(
+        self.data, self.record_table + number * BSM_INDEX_ENTRY.size))
+
+  # First time entry whose timestamp is not lower than timestamp.
+  def _LowerBound(self, timestamp):
+    low = 0
+    high = self.count
+    while low < high:
+      middle = (low + high) // 2
+      value, _ = BSM_INDEX_TIME.unpack_from(
+          self.data, self.time_table + middle * BSM_INDEX_TIME.size)
+      if value < timestamp:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  # Records between two timestamps (both included, None is unbounded).
+  #
+  # Returns:
+  #   The list of the record numbers, in the order of the file.
+  def TimeRange(self, since=None, until=None):
+    if since is None and until is None:
+      return range(self.count)
+    entry = 0
+    if since is not None:
+      entry = self._LowerBound(since)
+    numbers = []
+    while entry < self.count:
+      timestamp, number = BSM_INDEX_TIME.unpack_from(
+          self.data, self.time_table + entry * BSM_INDEX_TIME.size)
+      if until is not None and timestamp > until:
+        break
+      numbers.append(number)
+      entry += 1
+    numbers.sort()
+    return numbers
+
+# Build the record index of a BSM file in one pass over the headers.
+#
+# Args:
+#   f: the BSM file.
+#   path: where the index is saved, None to only keep it in memory.
+#
+# Returns:
+#   A BSMIndex.
+def BuildBSMIndex(f, path=None):
+  status = os.fstat(f.fileno())
+  data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  index = []
+  times = []
+  for offset, token_id, header in ScanBSMHeaders(data):
+    times.append((header.timestamp, len(index)))
+    index.append(BSM_INDEX_ENTRY.pack(
+        offset, header.length, header.event_type, token_id, header.timestamp))
+  data.close()
+  times.sort()
+  for timestamp, number in times:
+    index.append(BSM_INDEX_TIME.pack(timestamp, number))
+  index.insert(0, BSM_INDEX_HEADER.pack(
+      BSM_INDEX_MAGIC, status.st_size, status.st_mtime, len(times)))
+  index = ''.join(index)
+  if path:
+    try:
+      with open(path, 'wb') as index_file:
+        index_file.write(index)
+    except IOError:
+      sys.stderr.write(
+          '[WARNING] Unable to save the index in {}.\n'.format(path))
+  return BSMIndex(index)
+
+# Open the record index of a BSM file.
+#
+# Args:
+#   path: where the index is saved.
+#   f: the BSM file.
+#
+# Returns:
+#   A BSMIndex, or None if there is no index or it belongs to another
+#   version of the file.
+def OpenBSMIndex(path, f):
+  try:
+    with open(path, 'rb') as index_file:
+      index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError):
+    return None
+  if (len(index) < BSM_INDEX_HEADER.size or
+      index[:len(BSM_INDEX_MAGIC)] != BSM_INDEX_MAGIC):
+    return None
+  index = BSMIndex(index)
+  status = os.fstat(f.fileno())
+  if (index.file_size != status.st_size or
+      index.mtime != status.st_mtime or
+      len(index.data) != index.time_table + index.count * BSM_INDEX_TIME.size):
+    return None
+  return index
+
+#### COMPRESSED TRAILS ####
+
+# Magic numbers of the compressed trails.
+BSM_GZIP_MAGIC = '\x1f\x8b'
+BSM_BZIP2_MAGIC = 'BZh'
+BSM_XZ_MAGIC = '\xfd7zXZ\x00'
+
+# Start of a bzip2 block (pi) and end of a bzip2 stream (sqrt(pi)), they are
+# 48 bits that are not aligned to the bytes of the file.
+BSM_BZIP2_BLOCK = 0x314159265359
+BSM_BZIP2_END = 0x177245385090
+
+# Type of compression of a trail.
+#
+# Args:
+#   data: the first bytes of the trail.
+#
+# Returns:
+#   'gzip', 'bzip2', 'xz' or None if it is not compressed.
+def CompressionType(data):
+  if data.startswith(BSM_GZIP_MAGIC):
+    return 'gzip'
+  if data.startswith(BSM_BZIP2_MAGIC) and data[3:4].isdigit():
+    return 'bzip2'
+  if data.startswith(BSM_XZ_MAGIC):
+    return 'xz'
+  return None
+
+# Errors of the xz decompressor.
+BSM_LZMA_ERRORS = (lzma.LZMAError,) if lzma is not None else ()
+
+# New decompressor of one gzip member or bzip2/xz stream.
+def _Decompressor(compression):
+  if compression == 'gzip':
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+  if compression == 'bzip2':
+    return bz2.BZ2Decompressor()
+  if lzma is None:
+    print '[Error] The lzma module is needed to read xz files.'
+    exit(1)
+  return lzma.LZMADecompressor()
+
+# Decompressed view of a compressed BSM trail.
+#
+# As BSMStream, it never seeks. The gzip members and the bzip2 or xz streams
+# that are concatenated in the file are decompressed one after the other,
+# as gzip, bzip2 and xz do.
+class BSMCompressedFile(object):
+
+  # Args:
+  #   read: function that returns the next compressed bytes, '' at the end.
+  #   compression: 'gzip', 'bzip2' or 'xz'.
+  def __init__(self, read, compression):
+    self._read = read
+    self.compression = compression
+    self._decompressor = _Decompressor(compression)
+    self._pending = ''
+    self._eof = False
+
+  # Decompressed bytes, '' at the end of the trail.
+  #
+  # The size is only a hint, all the bytes decompressed from one read of the
+  # compressed file are returned.
+  def read(self, size=BSM_READ_SIZE):
+    while not self._eof:
+      data = self._pending or self._read(BSM_READ_SIZE)
+      self._pending = ''
+      if not data:
+        self._eof = True
+        break
+      try:
+        output = self._decompressor.decompress(data)
+        unused = self._decompressor.unused_data
+      except EOFError:
+        # A bzip2 or xz stream ended at the end of the previous read.
+        output = ''
+        unused = data
+      except (IOError, zlib.error) + BSM_LZMA_ERRORS as exception:
+        print '[Error] Corrupted {} data: {}'.format(
+            self.compression, exception)
+        exit(1)
+      if unused:
+        self._NextStream(unused)
+      if output:
+        return output
+    return ''
+
+  # Start the next member or stream, anything else after the end of the
+  # last one (as the zero padding of the tapes) is ignored.
+  def _NextStream(self, unused):
+    # The magic number can be cut by the end of the read.
+    while len(unused) < len(BSM_XZ_MAGIC):
+      data = self._read(BSM_READ_SIZE)
+      if not data:
+        break
+      unused += data
+    if CompressionType(unused) != self.compression:
+      self._eof = True
       return
-  print '\tEvent: {}.\n\tType: {}.\n\tTimestamp: {}.'.format(
-      event_number, event_type, human_timestamp)
-  for i in range(len(data)):
-    print u'\t{}'.format(data[i])
-  print ''
+    self._decompressor = _Decompressor(self.compression)
+    self._pending = unused
+
+# Value of bits of data.
+#
+# Args:
+#   data: the memory mapped compressed file.
+#   start: position of the first bit, the most significant bit of a byte is
+#          the first.
+#   bits: number of bits.
+def _BitsValue(data, start, bits):
+  if not bits:
+    return 0
+  first = start // 8
+  last = (start + bits + 7) // 8
+  value = int(binascii.hexlify(data[first:last]), 16)
+  value >>= 8 * (last - first) - start % 8 - bits
+  return value & ((1 << bits) - 1)
+
+# Bytes of a range of bits of data followed by tail, padded with zeros to
+# a whole byte.
+#
+# Args:
+#   data: the memory mapped compressed file.
+#   start: position of the first bit.
+#   end: position after the last bit.
+#   tail: value of the bits added after end.
+#   tail_bits: number of bits of tail.
+#
+# Yields:
+#   The bytes, BSM_READ_SIZE at a time.
+def _ReadBits(data, start, end, tail=0, tail_bits=0):
+  chunk_bits = 8 * BSM_READ_SIZE
+  while end - start > chunk_bits:
+    yield binascii.unhexlify('{:0{}x}'.format(
+        _BitsValue(data, start, chunk_bits), 2 * BSM_READ_SIZE))
+    start += chunk_bits
+  bits = end - start + tail_bits
+  padding = -bits % 8
+  value = ((_BitsValue(data, start, end - start) << tail_bits | tail) <<
+           padding)
+  if bits:
+    yield binascii.unhexlify('{:0{}x}'.format(value, (bits + padding) // 4))
+
+# Positions of a 48 bits pattern in data, at any bit.
+#
+# The whole bytes of each of the 8 possible alignments of the pattern are
+# searched, and then the bits at both ends are checked.
+#
+# Yields:
+#   The bit positions, sorted by alignment and then by position.
+def _FindBits(data, pattern):
+  for shift in range(8):
+    window = pattern << (8 - shift)
+    window = binascii.unhexlify('{:014x}'.format(window))
+    first = 1 if shift else 0
+    needle = window[first:6]
+    position = data.find(needle)
+    while position != -1:
+      start = 8 * (position - first) + shift
+      if start >= 0 and _BitsValue(data, start, 48) == pattern:
+        yield start
+      position = data.find(needle, position + 1)
+
+# Combined CRC of a bzip2 stream, computed from the CRCs of its blocks.
+def _CombineCRC(crcs):
+  combined = 0
+  for crc in crcs:
+    combined = ((combined << 1 | combined >> 31) & 0xFFFFFFFF) ^ crc
+  return combined
+
+# Blocks of a compressed trail that can be decompressed on their own.
+#
+# They are the gzip members, usually one unless the file was compressed in
+# blocks (bgzip, pigz --independent) or several files were concatenated,
+# and the bzip2 blocks, of at most 900 KB of decompressed data each.
+#
+# Args:
+#   data: the memory mapped compressed file.
+#   compression: 'gzip' or 'bzip2'.
+#
+# Yields:
+#   (point, output): point is the BSMSeekPoint of a block that starts before
+#   output, or None; output is decompressed data.
+def _DecompressBlocks(data, compression):
+  size = len(data)
+  position = 0
+  if compression == 'gzip':
+    while data[position:position + 2] == BSM_GZIP_MAGIC:
+      yield BSMSeekPoint(8 * position, 0, 0, 0, 0, 0, 0, 0, 0), ''
+      decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      while not decompressor.unused_data and position < size:
+        chunk = data[position:position + BSM_READ_SIZE]
+        position += len(chunk)
+        yield None, decompressor.decompress(chunk)
+      position -= len(decompressor.unused_data)
+    return
+  ends = sorted(_FindBits(data, BSM_BZIP2_END))
+  blocks = sorted(_FindBits(data, BSM_BZIP2_BLOCK))
+  while (CompressionType(data[position:position + 4]) == 'bzip2' and ends and
+         ends[0] > 8 * position):
+    end = ends.pop(0)
+    stream = [block for block in blocks if 8 * position < block < end]
+    crcs = [_BitsValue(data, block + 48, 32) for block in stream]
+    level = data[position + 3]
+    for number, block in enumerate(stream):
+      # Each block is decompressed as a stream of its own, the decompressor
+      # keeps back part of the output until it is given more data.
+      following = stream[number + 1] if number + 1 < len(stream) else end
+      output = bz2.decompress(BSM_BZIP2_MAGIC + level + ''.join(_ReadBits(
+          data, block, following, BSM_BZIP2_END << 32 | crcs[number], 80)))
+      yield (BSMSeekPoint(
+          block, ord(level), end, _CombineCRC(crcs[number:]), 0, 0, 0, 0, 0),
+             output)
+    position = (end + 80 + 7) // 8
+
+#### SEEK INDEX ####
+
+# Seek index of a compressed trail: [Index_Header][Seek_Point]*
+# The header is the one of the record index, with the size and modification
+# time of the compressed file.
+BSM_SEEK_MAGIC = 'BSMSDX\x00\x01'
+BSM_SEEK_POINT = struct.Struct('>QBQIQQQQQ')
+BSM_SEEK_EXTENSION = '.sdx'
+
+# Decompressed bytes between two seek points.
+BSM_SEEK_INTERVAL = 16 * 1024 * 1024
+
+# Block of a compressed trail where the decompression can start.
+#   bit: position of the block in the compressed file, in bits.
+#   level: block size of the bzip2 stream ('1' to '9'), 0 in gzip.
+#   end: bit of the end of the bzip2 stream of the block.
+#   crc: combined CRC of the bzip2 blocks from this one to the end.
+#   offset: position of the block in the decompressed trail.
+#   record: position of the first record that starts in the block.
+#   number: number of records before it.
+#   before: greatest timestamp of the records before it, 0 if none.
+#   after: lowest timestamp of the records from it.
+BSMSeekPoint = collections.namedtuple('BSMSeekPoint', [
+    'bit', 'level', 'end', 'crc', 'offset', 'record', 'number', 'before',
+    'after'])
+
+# Start of the compressed file, as a gzip member or the header of a bzip2
+# stream. It is the only point of a trail without records.
+BSM_SEEK_START = BSMSeekPoint(0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+# Seek index of a compressed BSM trail saved next to it.
+#
+# Time bounded queries decompress the trail from the last seek point that
+# only has older records before it, and stop at the first one that only has
+# newer records after it. The records are not required to be sorted.
+class BSMSeekIndex(object):
+
+  def __init__(self, data):
+    self.data = data
+    _, self.file_size, self.mtime, self.count = (
+        BSM_INDEX_HEADER.unpack_from(data, 0))
+
+  # Seek point by its number, the first one is 0.
+  def Point(self, number):
+    return BSMSeekPoint._make(BSM_SEEK_POINT.unpack_from(
+        self.data, BSM_INDEX_HEADER.size + number * BSM_SEEK_POINT.size))
+
+  # First seek point whose field is greater than value, the field must grow
+  # with the number of the seek point.
+  def _UpperBound(self, field, value, low=0):
+    high = self.count
+    while low < high:
+      middle = (low + high) // 2
+      if getattr(self.Point(middle), field) <= value:
+        low = middle + 1
+      else:
+        high = middle
+    return low
+
+  # Part of the trail with the records between two timestamps (both
+  # included, None is unbounded).
+  #
+  # Returns:
+  #   (point, stop): the BSMSeekPoint where the decompression starts and the
+  #   decompressed position of the first record that can not be in the range,
+  #   None to read up to the end.
+  def Range(self, since=None, until=None):
+    if not self.count:
+      return BSM_SEEK_START, None
+    start = 0
+    if since is not None:
+      # Every record before a point whose "before" is lower than since is
+      # older than since.
+      start = max(self._UpperBound('before', since - 1) - 1, 0)
+    stop = None
+    if until is not None:
+      last = self._UpperBound('after', until, start + 1)
+      if last < self.count:
+        stop = self.Point(last).record
+    return self.Point(start), stop
+
+# Decompressed trail from a seek point.
+#
+# A gzip member starts a gzip file. A bzip2 block does not start on a byte,
+# so it is shifted after a bzip2 stream header, and followed by the end of
+# the stream with the CRC of the blocks that were read.
+#
+# Args:
+#   data: the memory mapped compressed file.
+#   compression: 'gzip' or 'bzip2'.
+#   point: the BSMSeekPoint.
+#
+# Returns:
+#   A BSMCompressedFile, its first byte is at point.offset.
+def OpenBSMSeekPoint(data, compression, point):
+  chunks = []
+  position = point.bit // 8
+  if point.level:
+    position = (point.end + 80 + 7) // 8
+    chunks.append([BSM_BZIP2_MAGIC + chr(point.level)])
+    chunks.append(_ReadBits(
+        data, point.bit, point.end, BSM_BZIP2_END << 32 | point.crc, 80))
+  chunks.append(
+      data[offset:offset + BSM_READ_SIZE]
+      for offset in xrange(position, len(data), BSM_READ_SIZE))
+  chunks = itertools.chain(*chunks)
+  return BSMCompressedFile(lambda size: next(chunks, ''), compression)
+
+# Build the seek index of a compressed BSM trail in one pass.
+#
+# Args:
+#   f: the compressed BSM file.
+#   compression: 'gzip' or 'bzip2'.
+#   path: where the index is saved, None to only keep it in memory.
+#   interval: decompressed bytes between two seek points, they are at least
+#             this far apart.
+#   max_record_size: bigger records stop the parsing.
+#
+# Returns:
+#   A BSMSeekIndex.
+def BuildBSMSeekIndex(f, compression, path=None, interval=BSM_SEEK_INTERVAL,
+                      max_record_size=BSM_MAX_RECORD_SIZE):
+  status = os.fstat(f.fileno())
+  data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  blocks = _DecompressBlocks(data, compression)
+  pending = []
+
+  # Blocks seen ahead of the records, at least interval bytes apart.
+  class Decompressed(object):
+    offset = 0
+    kept = None
+    def read(self, size):
+      for point, output in blocks:
+        if point and (self.kept is None or
+                      self.offset - self.kept >= interval):
+          self.kept = self.offset
+          pending.append(point._replace(offset=self.offset))
+        if output:
+          self.offset += len(output)
+          return output
+      return ''
+
+  points = []
+  newest = 0
+  number = 0
+  for record in ReadBSMRecords(BSMStream(Decompressed(), max_record_size)):
+    if pending and pending[0].offset <= record.offset:
+      while pending and pending[0].offset <= record.offset:
+        point = pending.pop(0)
+      points.append(point._replace(
+          record=record.offset, number=number, before=newest,
+          after=record.timestamp))
+    elif not points:
+      # The first record comes before any block, the file is read from its
+      # start.
+      points.append(BSM_SEEK_START._replace(
+          record=record.offset, after=record.timestamp))
+    newest = max(newest, record.timestamp)
+    points[-1] = points[-1]._replace(
+        after=min(points[-1].after, record.timestamp))
+    number += 1
+  data.close()
+  if not points:
+    points.append(BSM_SEEK_START)
+  for number in range(len(points) - 2, -1, -1):
+    points[number] = points[number]._replace(
+        after=min(points[number].after, points[number + 1].after))
+  index = [BSM_INDEX_HEADER.pack(
+      BSM_SEEK_MAGIC, status.st_size, status.st_mtime, len(points))]
+  index.extend(BSM_SEEK_POINT.pack(*point) for point in points)
+  index = ''.join(index)
+  if path:
+    try:
+      with open(path, 'wb') as index_file:
+        index_file.write(index)
+    except IOError:
+      sys.stderr.write(
+          '[WARNING] Unable to save the seek index in {}.\n'.format(path))
+  return BSMSeekIndex(index)
+
+# Open the seek index of a compressed BSM trail.
+#
+# Args:
+#   path: where the index is saved.
+#   f: the compressed BSM file.
+#
+# Returns:
+#   A BSMSeekIndex, or None if there is no index or it belongs to another
+#   version of the file.
+def OpenBSMSeekIndex(path, f):
+  try:
+    with open(path, 'rb') as index_file:
+      index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+  except (EnvironmentError, ValueError):
+    return None
+  if (len(index) < BSM_INDEX_HEADER.size or
+      index[:len(BSM_SEEK_MAGIC)] != BSM_SEEK_MAGIC):
+    return None
+  index = BSMSeekIndex(index)
+  status = os.fstat(f.fileno())
+  if (index.file_size != status.st_size or
+      index.mtime != status.st_mtime or
+      len(index.data) != (BSM_INDEX_HEADER.size +
+                          index.count * BSM_SEEK_POINT.size)):
+    return None
+  return index
+
+#### PARALLEL PARSING ####
+
+# Size of the chunks of a BSM file given to each worker process.
+BSM_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Trailer token at the end of every record: token ID, magic, record_length.
+BSM_TRAILER = struct.Struct('>BHI')
+BSM_TRAILER_ID = 19
+BSM_TRAILER_MAGIC = int(BSM_TOKEN_TRAILER_MAGIC, 16)
+
+# Candidates to the first byte of a record.
+BSM_HEADER_PATTERN = re.compile(
+    '[' + ''.join(re.escape(chr(token_id)) for token_id in BSM_HEADER_SIZE) +
+    ']')
+
+# Result of parsing a chunk.
+# All the records of the chunk were parsed.
+BSM_CHUNK_DONE = 0
+# Zero padding, there are no more records in the file.
+BSM_CHUNK_STOP = 1
+# There is no header token at the offset where the parsing stopped.
+BSM_CHUNK_ERROR = 2
+# The decoder stopped the program, it already printed the reason.
+BSM_CHUNK_EXIT = 3
+
+# Check that a record starts at offset.
+#
+# The record must start with a header token, end with a trailer token with
+# the same length and be followed by another header, padding or the end of
+# the file.
+#
+# Args:
+#   data: the memory mapped BSM file.
+#   offset: where the record would start.
+#
+# Returns:
+#   True if it is a record boundary.
+def IsBSMRecordStart(data, offset):
+  size = len(data)
+  token_id = ord(data[offset])
+  if (token_id not in BSM_HEADER_SIZE or
+      offset + BSM_RECORD_START.size > size):
+    return False
+  _, length = BSM_RECORD_START.unpack_from(data, offset)
+  end = offset + length
+  if length < BSM_HEADER_SIZE[token_id] + BSM_TRAILER.size or end > size:
+    return False
+  trailer = BSM_TRAILER.unpack_from(data, end - BSM_TRAILER.size)
+  if trailer != (BSM_TRAILER_ID, BSM_TRAILER_MAGIC, length):
+    return False
+  return end == size or ord(data[end]) in BSM_HEADER_SIZE or not ord(data[end])
+
+# First record boundary (IsBSMRecordStart) at or after offset.
+#
+# Returns:
+#   The offset of the record, or the size of the file if there is none.
+def FindBSMRecordStart(data, offset):
+  match = BSM_HEADER_PATTERN.search(data, offset)
+  while match:
+    if IsBSMRecordStart(data, match.start()):
+      return match.start()
+    match = BSM_HEADER_PATTERN.search(data, match.start() + 1)
+  return len(data)
+
+# Cut a BSM file in chunks of about chunk_size bytes at record boundaries.
+#
+# Yields:
+#   (start, end) of each chunk, in the order of the file.
+def SplitBSMFile(data, chunk_size=BSM_CHUNK_SIZE):
+  size = len(data)
+  start = 0
+  while start < size:
+    end = size
+    if start + chunk_size < size:
+      end = FindBSMRecordStart(data, start + chunk_size)
+    yield start, end
+    start = end
+
+# Parse the records of a chunk of a BSM file.
+#
+# It runs in the worker processes of ParseBSMParallel, the events are
+# formatted and encoded here and only numbered and written by the parent.
+#
+# Args:
+#   task: (path, start, end, decoder, since, until, encoding), decoder is
+#         one of BSM_DECODERS, since/until the time window (None is
+#         unbounded) and encoding the one of the output.
+#
+# Returns:
+#   (events, offset, status): events has the result of FormatBSMEvent for
+#   each record with the text encoded, or None if the record is outside the
+#   time window, offset is where the parsing stopped and status one of the
+#   BSM_CHUNK_* values.
+def ParseBSMChunk(task):
+  path, start, end, decoder, since, until, encoding = task
+  with open(path, 'rb') as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  size = len(data)
+  events = []
+  offset = start
+  try:
+    while offset < end:
+      token_id = ord(data[offset])
+      if not token_id:
+        return events, offset, BSM_CHUNK_STOP
+      if (token_id not in BSM_HEADER_SIZE or
+          offset + BSM_RECORD_START.size > size):
+        return events, offset, BSM_CHUNK_ERROR
+      _, length = BSM_RECORD_START.unpack_from(data, offset)
+      record = data[offset:offset + max(length, BSM_HEADER_SIZE[token_id])]
+      timestamp = DecodeBSMHeader(record).timestamp
+      if ((since is not None and timestamp < since) or
+          (until is not None and timestamp > until)):
+        events.append(None)
+      else:
+        title, text = FormatBSMEvent(
+            DecodeBSMEvent(record, offset, decoder), offset)
+        if text is not None:
+          text = text.encode(encoding)
+        events.append((title, text))
+      offset += len(record)
+      # A corrupted length, the next chunk starts at a verified record.
+      if offset > end:
+        logging.warning(
+            u'The record at 0x{0:X} goes beyond the record at 0x{1:X}.'.format(
+                offset - len(record), end))
+        offset = end
+  except SystemExit:
+    sys.stdout.flush()
+    return events, offset, BSM_CHUNK_EXIT
+  finally:
+    data.close()
+  return events, offset, BSM_CHUNK_DONE
+
+# Parse a BSM file with a pool of worker processes.
+#
+# The file is cut in chunks at verified record boundaries (SplitBSMFile) and
+# each worker parses whole chunks. The results are printed in the order of
+# the file through a reorder buffer, which holds at most two chunks per
+# process: a chunk is only printed when all the previous ones were printed.
+#
+# On a sound file the output is the one of the sequential parser. If the
+# length of a record is corrupted, the parsing continues at the next chunk
+# instead of following the wrong length.
+#
+# Args:
+#   path: the BSM file.
+#   processes: size of the process pool, None uses all the CPUs.
+#   chunk_size: approximate size of the chunks.
+#   decoder: one of BSM_DECODERS.
+#   since, until: time window, None is unbounded.
+def ParseBSMParallel(path, processes=None, chunk_size=BSM_CHUNK_SIZE,
+                     decoder='struct', since=None, until=None):
+  with open(path, 'rb') as f:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  processes = processes or multiprocessing.cpu_count()
+  # The same encoding print uses.
+  encoding = sys.stdout.encoding or sys.getdefaultencoding()
+  chunks = SplitBSMFile(data, chunk_size)
+  pending = collections.deque()
+  event_number = 0
+  pool = multiprocessing.Pool(processes)
+  try:
+    while True:
+      while len(pending) < 2 * processes:
+        chunk = next(chunks, None)
+        if chunk is None:
+          break
+        start, end = chunk
+        pending.append((end, pool.apply_async(
+            ParseBSMChunk,
+            ((path, start, end, decoder, since, until, encoding),))))
+      if not pending:
+        break
+      end, result = pending.popleft()
+      events, offset, status = result.get()
+      for formatted in events:
+        event_number += 1
+        if formatted is None:
+          continue
+        title, text = formatted
+        if title is not None:
+          sys.stdout.write('{}{}{}\n'.format(title, event_number, text))
+        elif text is not None:
+          sys.stdout.write(text + '\n')
+      if status == BSM_CHUNK_STOP:
+        break
+      elif status == BSM_CHUNK_ERROR:
+        print "[Error] At 0x{:X} header unknown.".format(offset + 1)
+        exit(1)
+      elif status == BSM_CHUNK_EXIT:
+        exit(1)
+  finally:
+    pool.terminate()
+    pool.join()
+    data.close()
 
 # Check if the file is a BSM file.
 #
 # Args:
-#   f : file that we want to check.
-def VerifyFile(f):
-  type = BSM_TYPE.parse_stream(f)
-  if (BSM_TYPE_LIST[type][0] != 'BSM_HEADER32' and
-      BSM_TYPE_LIST[type][0] != 'BSM_HEADER64' and
-      BSM_TYPE_LIST[type][0] != 'BSM_HEADER32_ex'):
+#   data: the first bytes of the file, at least BSM_VERIFY_SIZE.
+def VerifyFile(data):
+  if not data or ord(data[0]) not in BSM_HEADER_SIZE:
     print '[Error] It is not a BSM file, unknown header token_id.'
     exit(1) 
   try: 
-    header = BSM_HEADER.parse_stream(f)
-  except:
+    header = BSM_HEADER.parse(data[1:BSM_VERIFY_SIZE])
+  except construct.ConstructError:
     print '[Error] It is not a BSM file, not a header structure.'
     exit(1)
   if header.version != AUDIT_HEADER_VERSION:
     print '[WARNING] BSM version {} not supported.'.format(header.version)
-  f.close()
   
   
 
+# Convert a time of the command line to an epoch timestamp.
+#
+# Args:
+#   text: epoch, "YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DD" in UTC.
+def ParseTime(text):
+  if text.isdigit():
+    return int(text)
+  for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+    try:
+      return calendar.timegm(time.strptime(text, time_format))
+    except ValueError:
+      pass
+  raise argparse.ArgumentTypeError(
+      'invalid time "{}", use epoch or YYYY-MM-DD [HH:MM:SS]'.format(text))
+
 # Main function.
 def __init__():
-  if len(sys.argv) != 2:
-    print 'Use: python {0} BSMfile'.format(sys.argv[0])
-    exit(1)
-  log = sys.argv[1]
-  try:
-    f = open(log, 'rb')
-  except:
-    print '[Error] The file BSM does not exist'
-    exit(1)
-    
-  VerifyFile(f)
+  parser = argparse.ArgumentParser(description='Basic Security Module parser.')
+  parser.add_argument(
+      'log', metavar='BSMfile',
+      help='BSM file to parse, it can be compressed with gzip, bzip2 or xz; '
+           '- reads it from the standard input.')
+  parser.add_argument(
+      '--decoder', choices=BSM_DECODERS, default='struct',
+      help='struct (default), construct (reference implementation) or '
+           'verify (decode with both and stop if they disagree).')
+  parser.add_argument(
+      '--since', metavar='TIME', type=ParseTime,
+      help='Only the events from TIME (UTC), epoch or YYYY-MM-DD [HH:MM:SS].')
+  parser.add_argument(
+      '--until', metavar='TIME', type=ParseTime,
+      help='Only the events up to TIME (UTC), included.')
+  parser.add_argument(
+      '--count', action='store_true',
+      help='Only print the number of events, the tokens are not read.')
+  parser.add_argument(
+      '--index', action='store_true',
+      help='Use the record index of the file to find the events, it is built '
+           'if it does not exist or the file changed.')
+  parser.add_argument(
+      '--index-file', metavar='PATH',
+      help='Where the record index is saved (default: BSMfile{}).'.format(
+          BSM_INDEX_EXTENSION))
+  parser.add_argument(
+      '--processes', type=int, metavar='N',
+      help='Parse the file in chunks with N worker processes, 0 uses all the '
+           'CPUs.')
+  parser.add_argument(
+      '--chunk-size', type=int, metavar='MB',
+      default=BSM_CHUNK_SIZE // (1024 * 1024),
+      help='Size of the chunks given to the worker processes (default: '
+           '%(default)s).')
+  parser.add_argument(
+      '--seek-index', action='store_true',
+      help='Use the seek index of a gzip or bzip2 file to only decompress the '
+           'part with the events from --since until --until, it is built if '
+           'it does not exist or the file changed.')
+  parser.add_argument(
+      '--seek-index-file', metavar='PATH',
+      help='Where the seek index is saved (default: BSMfile{}).'.format(
+          BSM_SEEK_EXTENSION))
+  parser.add_argument(
+      '--seek-interval', type=int, metavar='MB',
+      default=BSM_SEEK_INTERVAL // (1024 * 1024),
+      help='Decompressed MB between the seek points of a new seek index '
+           '(default: %(default)s).')
+  parser.add_argument(
+      '--max-record-size', type=int, default=BSM_MAX_RECORD_SIZE,
+      metavar='BYTES',
+      help='A bigger record is considered corrupted and stops the parsing '
+           '(default: %(default)s).')
+  options = parser.parse_args()
+  if options.processes is not None and (options.index or options.count):
+    parser.error('--processes is not available with --index or --count.')
+  if options.seek_index and (options.index or options.processes is not None):
+    parser.error('--seek-index is not available with --index or --processes.')
+  if options.chunk_size <= 0 or options.seek_interval <= 0:
+    parser.error('--chunk-size and --seek-interval must be positive.')
+  if options.log == '-' and (options.index or options.seek_index or
+                             options.processes is not None):
+    parser.error(
+        '--index, --seek-index and --processes need a file, not a stream.')
+  log = options.log
+  if log == '-':
+    f = sys.stdin
+  else:
+    try:
+      f = open(log, 'rb')
+    except:
+      print '[Error] The file BSM does not exist'
+      exit(1)
+  # The file is opened once and only read, the first record stays buffered.
+  stream = BSMStream(f, options.max_record_size)
+  compression = CompressionType(stream.Peek(len(BSM_XZ_MAGIC)))
+  if compression and (options.index or options.processes is not None):
+    parser.error('--index and --processes need an uncompressed file.')
+  if options.seek_index and compression not in ('gzip', 'bzip2'):
+    parser.error('--seek-index needs a gzip or bzip2 file.')
+  if compression:
+    stream = BSMStream(
+        BSMCompressedFile(stream.read, compression), options.max_record_size)
+
+  VerifyFile(stream.Peek(BSM_VERIFY_SIZE))
   print '\nParsing BSM file [{}].\n'.format(log)
 
-  try:
-    f = open(log, 'rb')
-  except:
-    print '[Error] The file BSM does not exist'
-    exit(1)
+  def inWindow(timestamp):
+    return ((options.since is None or timestamp >= options.since) and
+            (options.until is None or timestamp <= options.until))
+
+  if options.index:
+    index_file = options.index_file or log + BSM_INDEX_EXTENSION
+    index = OpenBSMIndex(index_file, f)
+    if index is None:
+      index = BuildBSMIndex(f, index_file)
+    numbers = index.TimeRange(options.since, options.until)
+    if options.count:
+      print 'Events: {}.'.format(len(numbers))
+    else:
+      for number in numbers:
+        offset = index.Entry(number).offset
+        f.seek(offset)
+        PrintBSMEvent(
+            DecodeBSMEvent(ReadBSMRecord(f), offset, options.decoder),
+            number + 1, offset)
+    f.close()
+    return
+
+  if options.processes is not None:
+    f.close()
+    ParseBSMParallel(
+        log, options.processes or None, options.chunk_size * 1024 * 1024,
+        options.decoder, options.since, options.until)
+    return
+
+  if options.count and log != '-' and not compression:
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    events = 0
+    for _, _, header in ScanBSMHeaders(data):
+      if inWindow(header.timestamp):
+        events += 1
+    print 'Events: {}.'.format(events)
+    data.close()
+    f.close()
+    return
+
+  first = 0
+  stop = None
   event_number = 0
-  token_id = BSM_TYPE.parse_stream(f)
-  while token_id:
+  if options.seek_index:
+    index_file = options.seek_index_file or log + BSM_SEEK_EXTENSION
+    index = OpenBSMSeekIndex(index_file, f)
+    if index is None:
+      index = BuildBSMSeekIndex(
+          f, compression, index_file, options.seek_interval * 1024 * 1024,
+          options.max_record_size)
+    point, stop = index.Range(options.since, options.until)
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    stream = BSMStream(
+        OpenBSMSeekPoint(data, compression, point), options.max_record_size)
+    stream.Skip(point.record - point.offset)
+    first = point.record
+    event_number = point.number
+
+  events = 0
+  for record in ReadBSMRecords(stream, first):
+    if stop is not None and record.offset >= stop:
+      break
     event_number += 1
-    ReadBSMEvent(f, token_id, event_number)
-    try:
-      token_id = BSM_TYPE.parse_stream(f)
-    except:
-      token_id = None
-  f.close() 
+    if not inWindow(record.timestamp):
+      continue
+    if options.count:
+      events += 1
+    else:
+      PrintBSMEvent(
+          record.Event(options.decoder), event_number, record.offset)
+  if options.count:
+    print 'Events: {}.'.format(events)
+  if options.seek_index:
+    data.close()
+  f.close()
     
 
-__init__()
-
+if __name__ == '__main__':
+  __init__()